@@ -51,17 +51,41 @@
        to store all of the factors and variables associated with a
        Bayes Net in one place.
 
+    D) class LRUCache A bounded cache used by the BN to keep results 
+       (e.g., elimination orderings) that are reused across queries.
+
+    E) class QueryPool A pool of worker processes that each hold a copy
+       of a Bayes net and answer VE queries sent to them.
+
     '''
 
-class Variable:
+import collections
+import heapq
+import itertools
+import json
+import multiprocessing
+import re
+import struct
+import threading
+import xml.etree.cElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+class Variable(object):
     '''Class for defining Bayes Net variables. '''
+
+    #Bayes nets can have thousands of variables, keep the objects small
+    __slots__ = ('name', 'dom', 'dom_index', 'evidence_index', 'assignment_index')
     
     def __init__(self, name, domain=[]):
         '''Create a variable object, specifying its name (a
         string). Optionally specify the initial domain.
         '''
         self.name = name                #text name for variable
-        self.dom = list(domain)         #Make a copy of passed domain
+        self.dom = []                   #domain values (a copy of passed domain)
+        self.dom_index = {}             #maps each domain value to its index in self.dom
+        self.add_domain_values(domain)
         self.evidence_index = 0         #evidence value (stored as index into self.dom)
         self.assignment_index = 0       #For use by factors. We can assign variables values
                                         #and these assigned values can be used by factors
@@ -69,12 +93,26 @@ class Variable:
 
     def add_domain_values(self, values):
         '''Add domain values to the domain. values should be a list.'''
-        for val in values: self.dom.append(val)
+        for val in values:
+            #like list.index, a repeated value maps to its first position
+            self.dom_index.setdefault(val, len(self.dom))
+            self.dom.append(val)
+
+    def __getstate__(self):
+        # Objects with __slots__ have no __dict__ for pickle to save
+        return dict([(slot, getattr(self, slot)) for slot in self.__slots__])
+
+    def __setstate__(self, state):
+        for (slot, value) in state.items():
+            setattr(self, slot, value)
 
     def value_index(self, value):
         '''Domain values need not be numbers, so return the index
            in the domain list of a variable value'''
-        return self.dom.index(value)
+        try:
+            return self.dom_index[value]
+        except KeyError:
+            raise ValueError("{} is not in the domain of {}".format(value, self.name))
 
     def domain_size(self):
         '''Return the size of the domain'''
@@ -137,17 +175,59 @@ class Factor:
     like [[0.25]] to set the factor's single value. The get_value
     functions will still work.  E.g., get_value([]) will return the
     factor's single value. Constant factors can be generated during
-    variable elimination when a factor is restricted.'''
+    variable elimination when a factor is restricted.
+
+    The factor's table is stored in self.values as a float64 numpy
+    array with one axis per scope variable (in scope order), so the
+    value of the assignment (A=a_i, B=b_j, C=c_k) is
+    self.values[i, j, k]. A constant factor stores a 0-dimensional
+    array.
+
+    A factor can also be stored in log space (log_space = True): its
+    table then holds the natural logs of the factor's values, and the
+    factor operations (product, summing out) work on logs, which keeps
+    products of many small numbers from underflowing to 0. 
+    to_log_space/to_linear_space convert between the two.
 
-    def __init__(self, name, scope):
+    self.version counts the changes made to the values through 
+    add_values/add_value_at_current_assignment, so that results 
+    computed from them can be dropped when they change. Call 
+    mark_changed after writing to self.values directly.'''
+
+    def __init__(self, name, scope, values=None, log_space=False):
         '''create a Factor object, specify the Factor name (a string)
-        and its scope (an ORDERED list of variable objects).'''
+        and its scope (an ORDERED list of variable objects).
+        Optionally pass an already computed table (an array with one
+        axis per scope variable); it is used as is, without copying.
+        If log_space is set, the table holds logs of the values.'''
         self.scope = list(scope)
         self.name = name
-        size = 1
-        for v in scope:
-            size = size * v.domain_size()
-        self.values = [0]*size  #initialize values to be long list of zeros.
+        self.log_space = log_space
+        self.version = 0
+        if values is None:
+            #initialize values to a table of zeros (-inf in log space),
+            #one axis per variable
+            self.values = np.zeros([v.domain_size() for v in self.scope],
+                                   dtype=np.float64)
+            if log_space:
+                self.values.fill(-np.inf)
+        else:
+            self.values = np.asarray(values, dtype=np.float64)
+
+    def to_log_space(self):
+        '''Return this factor stored in log space (the factor itself if 
+        it already is)'''
+        if self.log_space:
+            return self
+        with np.errstate(divide='ignore'):
+            return Factor(self.name, self.scope, np.log(self.values), True)
+
+    def to_linear_space(self):
+        '''Return this factor with its values stored as is (the factor 
+        itself if it is not in log space)'''
+        if not self.log_space:
+            return self
+        return Factor(self.name, self.scope, np.exp(self.values))
 
     def get_scope(self):
         return list(self.scope)
@@ -172,12 +252,11 @@ class Factor:
          This list initializes the factor so that, e.g., its value on
          (A=2,B=b,C='light) is 2.25'''
 
+        n = len(self.scope)
         for t in values:
-            index = 0
-            for v in self.scope:
-                index = index * v.domain_size() + v.value_index(t[0])
-                t = t[1:]
-            self.values[index] = t[0]
+            index = tuple([v.value_index(val) for (v, val) in zip(self.scope, t)])
+            self.values[index] = t[n]
+        self.version += 1
          
     def add_value_at_current_assignment(self, number):
         '''This is a special purpose function for initializing a
@@ -195,10 +274,13 @@ class Factor:
         this factor to have the value 0.33 on the assigments (A=1,
         B='1', C='heavy')'''
 
-        index = 0
-        for v in self.scope:
-            index = index * v.domain_size() + v.get_assignment_index()
+        index = tuple([v.get_assignment_index() for v in self.scope])
         self.values[index] = number
+        self.version += 1
+
+    def mark_changed(self):
+        '''Record that the values of the factor were changed'''
+        self.version += 1
 
     def get_value(self, variable_values):
         '''This function is used to retrieve a value from the
@@ -210,10 +292,7 @@ class Factor:
         on the list [1, 'b', 'heavy'] we would get a return value
         equal to the value of this factor on the assignment (A=1,
         B='b', C='light')'''
-        index = 0
-        for v in self.scope:
-            index = index * v.domain_size() + v.value_index(variable_values[0])
-            variable_values = variable_values[1:]
+        index = tuple([v.value_index(val) for (v, val) in zip(self.scope, variable_values)])
         return self.values[index]
 
     def get_value_at_current_assignments(self):
@@ -229,84 +308,96 @@ class Factor:
         function would return the value of the factor on the
         assigments (A=1, B='1', C='heavy')'''
         
-        index = 0
-        for v in self.scope:
-            index = index * v.domain_size() + v.get_assignment_index()
+        index = tuple([v.get_assignment_index() for v in self.scope])
         return self.values[index]
 
     def print_table(self):
         '''print the factor's table'''
-        saved_values = []  #save and then restore the variable assigned values.
-        for v in self.scope:
-            saved_values.append(v.get_assignment_index())
-
-        self.recursive_print_values(self.scope)
-
-        for v in self.scope:
-            v.set_assignment_index(saved_values[0])
-            saved_values = saved_values[1:]
-        
-    def recursive_print_values(self, vars):
-        if len(vars) == 0:
-            print "[",
-            for v in self.scope:
-                print "{} = {},".format(v.name, v.get_assignment()),
-            print "] = {}".format(self.get_value_at_current_assignments())
-        else:
-            for val in vars[0].domain():
-                vars[0].set_assignment(val)
-                self.recursive_print_values(vars[1:])
+        domains = [v.domain() for v in self.scope]
+        for index in generate_index_assignments(self.scope):
+            row = ["["]
+            for (v, dom, i) in zip(self.scope, domains, index):
+                row.append("{} = {},".format(v.name, dom[i]))
+            row.append("] = {}".format(self.values[index]))
+            print " ".join(row)
 
     def __repr__(self):
         return("{}({})".format(self.name, map(lambda x: x.name, self.scope)))
     
-    def get_restricted_factor(self, restrictions):
+    def get_restricted_factor(self, restrictions, evidence=None):
         '''Apply restrictions (list of variables with evidence) to this factor 
-        and return a copy of the restricted factor. The returned factor has 
+        and return the restricted factor. The returned factor has 
         the same name, but reduced scope and values. The restriction variables  
-        must have evidence values assigned.'''
+        must have evidence values assigned, unless evidence (a dictionary 
+        mapping each restriction variable to the INDEX of its value) is
+        given.
+        The values of the returned factor are a view into this factor's
+        table (the evidence axes are indexed away), they are not copied.'''
         # Create new restricted factor
         new_scope = [var for var in self.get_scope() if var not in restrictions] 
         if new_scope:
-            new_factor = Factor(generate_factor_name(new_scope), new_scope) 
+            name = generate_factor_name(new_scope)
         else:
             # Since scope is empty, add last restrictions to the factor's name
-            new_factor = Factor('f'+str([x.name for x in restrictions]), new_scope) 
-            
-        # Generate list of possible assignments
-        # where restricted variables only take the evidence values
-        # and others take all values in their domains
-        assignments = generate_assignments(self.get_scope(), restrictions, 'evidence')
+            name = 'f'+str([x.name for x in restrictions])
             
-        # Initialize values (apply restriction)
-        # Use generated list of assignments to lookup values from this factor
-        # and store them to the new factor
-        restricted_indices = [self.scope.index(var) for var in restrictions]
-        # Create the argument 'values' for add_values() call
-        values = list()
-        for assignment in assignments:
-            # Keep the part of the assignment that is not in the restrictions
-            value = [assignment[i] for i in range(0, len(assignment)) 
-                     if i not in restricted_indices]
-            value.append(self.get_value(assignment)) 
-            values.append(value)
-        # Add values to the new factor
-        new_factor.add_values(values)
-        return new_factor
+        # Index the restricted axes by their evidence values and keep
+        # every other axis whole (the Ellipsis keeps a fully restricted
+        # table a 0-d view rather than a scalar copy)
+        if evidence is None:
+            evidence = dict([(var, var.evidence_index) for var in restrictions])
+        index = tuple([evidence[var] if var in restrictions else slice(None)
+                       for var in self.scope])
+        return Factor(name, new_scope, self.values[index + (Ellipsis,)], self.log_space)
         
 
 class BN:
-    '''Class for defining a Bayes Net.'''
-    def __init__(self, name, Vars, Factors):
+    '''Class for defining a Bayes Net.
+
+    The factors are taken to be the CPTs of the net, with the child 
+    variable first in the scope and its parents after it, e.g. 
+    Factor('P(B|A,H)', [B, A, H]). From them the net builds (and keeps
+    up to date as variables and factors are added) the indexes used by
+    the inference routines: the factors that mention each variable, 
+    the parents and children of each variable, and a topological order
+    of the variables (parents before children).
+
+    The net also caches the elimination orderings VE computes, keyed on
+    the ordering function, the query variable and the SET of evidence
+    variables (the ordering does not depend on the evidence values).
+    Use add_variables/add_factors to change the net, or call
+    clear_caches after modifying the net's Variables or Factors lists 
+    in place, so the indexes are rebuilt and stale orderings dropped.
+
+    If log_space is set, queries on the net (VE, compile_query) compute
+    in log space by default, see Factor.
+
+    If precompute is set, the net computes the prior marginals of all
+    its variables, and their marginals given evidence on the root 
+    variables, when it is built (see precompute_marginals). VE queries 
+    with no evidence, or with evidence only on roots, are then answered
+    by looking the marginals up when they were precomputed. The 
+    marginals are dropped when the values of any factor change (see 
+    Factor.version); call precompute_marginals to compute them again.'''
+    def __init__(self, name, Vars, Factors, cache_size=128, log_space=False,
+                 precompute=False, max_combinations=256):
         self.name = name
         self.Variables = list(Vars)
         self.Factors = list(Factors)
+        self.log_space = log_space
+        self.ordering_cache = LRUCache(cache_size)
+        self.precompute = False
+        self.marginal_table = dict()            # precomputed marginals
+        self.marginal_versions = None
+        self.build_indexes()
         for f in self.Factors:
             for v in f.get_scope():     
-                if not v in self.Variables:
+                if not v in self.var_set:
                     print "Bayes net initialization error"
                     print "Factor scope {} has variable {} that",
                     print " does not appear in list of variables {}.".format(map(lambda x: x.name, f.get_scope()), v.name, map(lambda x: x.name, Vars))
+        if precompute:
+            self.precompute_marginals(max_combinations)
 
     def factors(self):
         '''Return a new list of the factors. So we don't modify BN'''
@@ -315,6 +406,225 @@ class BN:
     def variables(self):
         return list(self.Variables)
 
+    def has_variable(self, var):
+        '''Return True if var is one of the net's variables'''
+        return var in self.var_set
+
+    def get_variable(self, name):
+        '''Return the net's variable with the given name'''
+        return self.var_names[name]
+
+    def factors_of(self, var):
+        '''Return the list of the net's factors that mention var'''
+        return list(self.var_factors.get(var, ()))
+
+    def parents(self, var):
+        '''Return the list of the parents of var (the variables after it
+        in the scope of its CPT)'''
+        return list(self.var_parents.get(var, ()))
+
+    def children(self, var):
+        '''Return the list of the variables that have var as a parent'''
+        return list(self.var_children.get(var, ()))
+
+    def cpt(self, var):
+        '''Return the CPT of var (the factor whose scope starts with var), 
+        or None if it has none'''
+        return self.var_cpt.get(var)
+
+    def roots(self):
+        '''Return the variables that have no parents'''
+        return [v for v in self.Variables if not self.var_parents.get(v)]
+
+    def topological_order(self):
+        '''Return the variables ordered so that every variable comes
+        after its parents'''
+        return list(self.topological)
+
+    def ancestors(self, Vars):
+        '''Return the set made of the variables in Vars and all their 
+        ancestors'''
+        result = set(Vars)
+        stack = list(result)
+        while stack:
+            for p in self.var_parents.get(stack.pop(), ()):
+                if p not in result:
+                    result.add(p)
+                    stack.append(p)
+        return result
+
+    def build_indexes(self):
+        '''(Re)build the variable, factor and parent/child indexes'''
+        self.var_set = set(self.Variables)
+        self.var_names = dict([(v.name, v) for v in self.Variables])
+        self.var_factors = dict()
+        self.var_parents = dict()
+        self.var_children = dict()
+        self.var_cpt = dict()
+        for f in self.Factors:
+            scope = f.get_scope()
+            for v in scope:
+                self.var_factors.setdefault(v, []).append(f)
+            if not scope:
+                continue
+            self.var_cpt.setdefault(scope[0], f)
+            parents = self.var_parents.setdefault(scope[0], [])
+            for p in scope[1:]:
+                if p not in parents:
+                    parents.append(p)
+                    self.var_children.setdefault(p, []).append(scope[0])
+        
+        # Topological order (Kahn's algorithm), following the order of
+        # self.Variables among variables that are ready at the same time
+        waiting = dict([(v, len(self.var_parents.get(v, ()))) for v in self.Variables])
+        ready = [v for v in self.Variables if waiting[v] == 0]
+        ready.reverse()
+        self.topological = []
+        while ready:
+            v = ready.pop()
+            self.topological.append(v)
+            for c in reversed(self.var_children.get(v, ())):
+                if c in waiting:
+                    waiting[c] -= 1
+                    if waiting[c] == 0:
+                        ready.append(c)
+        if len(self.topological) < len(self.Variables):
+            print "Bayes net initialization error"
+            print "The parents of the variables {} form a cycle.".format([v.name for v in self.Variables if v not in self.topological])
+
+    def add_variables(self, Vars):
+        '''Add variables to the net'''
+        self.Variables.extend(Vars)
+        self.clear_caches()
+
+    def add_factors(self, Factors):
+        '''Add factors to the net. Their variables must already be in 
+        the net.'''
+        for f in Factors:
+            for v in f.get_scope():
+                if not v in self.var_set:
+                    print "Factor scope {} has variable {} that does not appear in list of variables {}.".format(map(lambda x: x.name, f.get_scope()), v.name, map(lambda x: x.name, self.Variables))
+        self.Factors.extend(Factors)
+        self.clear_caches()
+
+    def clear_caches(self):
+        '''Rebuild the indexes and drop everything cached about the net
+        (e.g. elimination orderings). Called whenever the net changes.'''
+        self.build_indexes()
+        self.ordering_cache.clear()
+        self.marginal_table.clear()
+
+    def precompute_marginals(self, max_combinations=256):
+        '''Compute and keep the prior marginals of all the variables, and 
+        their marginals given evidence on the roots: on each root alone,
+        then on each pair of roots, and so on, for at most 
+        max_combinations evidence combinations in all (counting the
+        empty one). From then on, VE answers queries with no evidence or
+        with evidence only on roots from these marginals when they cover
+        the evidence (see root_marginals).'''
+        self.precompute = True
+        self.check_marginals()
+        tree = JunctionTree(self, min_fill_ordering)
+        combinations = 0
+        roots = self.roots()
+        for k in range(len(roots) + 1):
+            for subset in itertools.combinations(roots, k):
+                for indices in itertools.product(*[range(v.domain_size()) for v in subset]):
+                    if combinations >= max_combinations:
+                        return
+                    evidence = dict(zip(subset, indices))
+                    tree.enter_evidence(evidence)
+                    self.marginal_table[frozenset(evidence.items())] = tree.marginals()
+                    combinations += 1
+
+    def root_marginals(self, evidence):
+        '''If the net keeps precomputed marginals and all the variables in
+        evidence (a dictionary mapping variables to the INDICES of their
+        values) are roots and their combination was precomputed, return
+        a dictionary mapping each variable to its distribution given the
+        evidence. Otherwise return None (VE then eliminates as usual:
+        building a junction tree for a single query would cost more).'''
+        if not self.precompute:
+            return None
+        for var in evidence:
+            if var not in self.var_set or self.var_parents.get(var):
+                return None
+        self.check_marginals()
+        return self.marginal_table.get(frozenset(evidence.items()))
+
+    def check_marginals(self):
+        '''Drop the kept marginals if the values of any factor changed
+        since they were computed'''
+        versions = tuple([f.version for f in self.Factors])
+        if versions != self.marginal_versions:
+            self.marginal_table.clear()
+            self.marginal_versions = versions
+
+    def elimination_ordering(self, Factors, QueryVar, EvidenceVars, orderingFn):
+        '''Return orderingFn(Factors, QueryVar), where Factors are the
+        net's factors restricted by EvidenceVars. The ordering is
+        cached, so later queries for QueryVar with the same evidence 
+        variables (but possibly different evidence values) reuse it.'''
+        # (a list of query variables is keyed on as a set)
+        queries = frozenset(QueryVar) if isinstance(QueryVar, list) else QueryVar
+        key = (orderingFn, queries, frozenset(EvidenceVars))
+        order = self.ordering_cache.get(key)
+        if order is None:
+            order = orderingFn(Factors, QueryVar)
+            self.ordering_cache.put(key, order)
+        return list(order)
+
+
+class LRUCache:
+    '''A mapping that holds at most 'size' entries. When it is full,
+    adding an entry evicts the least recently used one. The cache can 
+    be shared by several threads. A pickled cache is empty when it is
+    loaded.'''
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Return the value stored for key (marking it as recently 
+        used), or default if there is none.'''
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        '''Store value for key, evicting the least recently used entry
+        if the cache is full.'''
+        if self.size <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            elif len(self.entries) >= self.size:
+                self.entries.popitem(last=False)
+            self.entries[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __getstate__(self):
+        return {'size': self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'])
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
 
 ###############################################################################
 # Bayes Net functions
@@ -323,68 +633,172 @@ class BN:
 def min_fill_ordering(Factors, QueryVar):
     '''Compute a min fill ordering given a list of factors. Return
     ordered list of variables from the scopes of the factors in
-    Factors. The QueryVar will NOT be part of the returned ordering.
-    The ordering is the min-fill ordering.'''
-    scopes = []
-    for f in Factors:
-        scopes.append(list(f.get_scope()))
-    Vars = []
-    for s in scopes:
-        for v in s:
-            if not v in Vars and v != QueryVar:
-                Vars.append(v)
+    Factors. The QueryVar will NOT be part of the returned ordering
+    (QueryVar may also be a list of variables, none of which is 
+    ordered, or None to order every variable).
+    The ordering is the min-fill ordering: at each step eliminate the
+    variable whose elimination adds the fewest new edges (fill-ins) to
+    the interaction graph, breaking ties by the number of neighbors.'''
+    return greedy_ordering(Factors, QueryVar, fill_score, True)
+
+def min_degree_ordering(Factors, QueryVar):
+    '''Same prototype as min_fill_ordering. At each step eliminate the
+    variable that generates a factor of smallest scope.'''
+    return greedy_ordering(Factors, QueryVar, degree_score, False)
+
+def min_weight_ordering(Factors, QueryVar):
+    '''Same prototype as min_fill_ordering. At each step eliminate the
+    variable that generates the smallest table, i.e., the one whose 
+    product of its own and its neighbors' domain sizes is smallest.'''
+    return greedy_ordering(Factors, QueryVar, weight_score, False)
+
+def weighted_min_fill_ordering(Factors, QueryVar):
+    '''Same prototype as min_fill_ordering. Like min-fill, but each 
+    fill-in edge (A, B) is weighted by A.domain_size()*B.domain_size(),
+    so the heuristic accounts for variables with large domains.'''
+    return greedy_ordering(Factors, QueryVar, weighted_fill_score, True)
+
+def degree_score(graph, var):
+    '''Number of neighbors of var in the interaction graph'''
+    return len(graph[var])
+
+def weight_score(graph, var):
+    '''Size of the table created by eliminating var'''
+    weight = var.domain_size()
+    for n in graph[var]:
+        weight *= n.domain_size()
+    return weight
+
+def fill_score(graph, var):
+    '''Number of fill-in edges created by eliminating var (ties broken by
+    the number of neighbors)'''
+    neighbors = list(graph[var])
+    fill = 0
+    for (i, a) in enumerate(neighbors):
+        for b in neighbors[i+1:]:
+            if b not in graph[a]:
+                fill += 1
+    return (fill, len(neighbors))
+
+def weighted_fill_score(graph, var):
+    '''Sum of the weights of the fill-in edges created by eliminating
+    var, where the weight of edge (A, B) is the product of the domain
+    sizes of A and B'''
+    neighbors = list(graph[var])
+    fill = 0
+    for (i, a) in enumerate(neighbors):
+        for b in neighbors[i+1:]:
+            if b not in graph[a]:
+                fill += a.domain_size() * b.domain_size()
+    return (fill, weight_score(graph, var))
+
+def greedy_ordering(Factors, QueryVar, scoreFn, two_hop):
+    '''Compute an elimination ordering of the variables in the scopes of 
+    Factors (except QueryVar, or the variables in QueryVar if it is a 
+    list) by greedily eliminating the variable with
+    the lowest scoreFn(graph, var) from the interaction graph of the
+    factors. Ties go to the variable seen first in the factors' scopes.
+
+    Scores are kept in a heap and only the variables whose score can
+    change are rescored after each elimination: the neighbors of the
+    eliminated variable, and when two_hop is set (for scores that look
+    at the edges among a variable's neighbors, like fill) their
+    neighbors as well.'''
+    (graph, Vars) = interaction_graph(Factors)
+    
+    # Heap of (score, position in Vars, variable). Entries whose score is
+    # out of date are skipped when popped.
+    position = dict([(v, i) for (i, v) in enumerate(Vars)])
+    kept = set(QueryVar) if isinstance(QueryVar, list) else set([QueryVar])
+    score = dict([(v, scoreFn(graph, v)) for v in Vars if v not in kept])
+    heap = [(score[v], position[v], v) for v in score]
+    heapq.heapify(heap)
     
     ordering = []
-    while Vars:
-        (var,new_scope) = min_fill_var(scopes,Vars)
+    while heap:
+        (s, pos, var) = heapq.heappop(heap)
+        if score.get(var) != s:
+            continue
+        del score[var]
         ordering.append(var)
-        if var in Vars:
-            Vars.remove(var)
-        scopes = remove_var(var, new_scope, scopes)
+        # Eliminating var connects all its neighbors to each other
+        neighbors = graph.pop(var)
+        for n in neighbors:
+            graph[n].discard(var)
+            graph[n].update(neighbors)
+            graph[n].discard(n)
+        affected = set(neighbors)
+        if two_hop:
+            for n in neighbors:
+                affected.update(graph[n])
+        for n in affected:
+            if n in score:
+                new_score = scoreFn(graph, n)
+                if new_score != score[n]:
+                    score[n] = new_score
+                    heapq.heappush(heap, (new_score, position[n], n))
     return ordering
 
-def min_fill_var(scopes, Vars):
-    '''Given a set of scopes (lists of lists of variables) compute and
-    return the variable with minimum fill in. This is the variable that
-    generates a factor of smallest scope when eliminated from the set
-    of scopes. Also return the new scope generated from eliminating
-    that variable.'''
-
-    minv = Vars[0]
-    (minfill,min_new_scope) = compute_fill(scopes,Vars[0])
-    for v in Vars[1:]:
-        (fill, new_scope) = compute_fill(scopes, v)
-        if fill < minfill:
-            minv = v
-            minfill = fill
-            min_new_scope = new_scope
-    return (minv, min_new_scope)
-
-def compute_fill(scopes, var):
-    '''Return the fill in scope generated by eliminating var from
-    scopes along with the size of this new scope'''
-    union = []
-    for s in scopes:
-        if var in s:
-            for v in s:
-                if not v in union:
-                    union.append(v)
-    if var in union: union.remove(var)
-    return (len(union), union)
-
-def remove_var(var, new_scope, scopes):
-    '''Return the new set of scopes that arise from eliminating var
-    from scopes'''
-
-    new_scopes = []
-    for s in scopes:
-        if not var in s:
-            new_scopes.append(s)
-    new_scopes.append(new_scope)
-    return new_scopes
+def interaction_graph(Factors):
+    '''Return the interaction graph of a list of factors: a dictionary
+    mapping each variable to the set of variables it shares a factor
+    with, along with the list of the variables in the order they
+    first appear in the factors' scopes.'''
+    graph = dict()
+    Vars = []
+    for f in Factors:
+        scope = f.get_scope()
+        for v in scope:
+            if v not in graph:
+                graph[v] = set()
+                Vars.append(v)
+            graph[v].update(scope)
+    for v in Vars:
+        graph[v].discard(v)
+    return (graph, Vars)
             
 
-def VE(Net, QueryVar, EvidenceVars, orderingFn):
+def relevant_factors(Net, QueryVar, EvidenceVars):
+    '''Return the factors of Net needed to compute the distribution of
+    QueryVar (a variable, or a list of variables for their joint 
+    distribution) given EvidenceVars. Two kinds of factors are left out,
+    since they only scale the result by a constant:
+    (a) the CPTs of barren nodes, i.e., variables that are neither an 
+        ancestor of QueryVar nor of an evidence variable (their CPTs
+        sum to one when they are eliminated), and
+    (b) the factors d-separated from QueryVar by the evidence, i.e.,
+        those whose restricted scope is not connected to QueryVar in 
+        the interaction graph of the remaining factors once the 
+        evidence variables are removed.
+    Constant factors are also left out.'''
+    QueryVars = QueryVar if isinstance(QueryVar, list) else [QueryVar]
+    ## (a) keep the CPTs of the ancestors of QueryVar and EvidenceVars
+    ancestors = Net.ancestors(QueryVars + list(EvidenceVars))
+    kept = set()
+    for v in ancestors:
+        for f in Net.factors_of(v):
+            if f.get_scope()[0] in ancestors:
+                kept.add(f)
+    
+    ## (b) keep the factors connected to QueryVar through non-evidence
+    # variables
+    evidence = set(EvidenceVars)
+    connected = set(QueryVars)
+    stack = list(QueryVars)
+    while stack:
+        for f in Net.factors_of(stack.pop()):
+            if f in kept:
+                for v in f.get_scope():
+                    if v not in connected and v not in evidence:
+                        connected.add(v)
+                        stack.append(v)
+    result = []
+    for f in Net.factors():
+        if f in kept and [v for v in f.get_scope() if v in connected]:
+            result.append(f)
+    return result
+
+def VE(Net, QueryVar, EvidenceVars, orderingFn, log_space=None):
     '''
     Input: Net---a BN object (a Bayes Net)
            QueryVar---a Variable object (the variable whose distribution
@@ -407,6 +821,10 @@ def VE(Net, QueryVar, EvidenceVars, orderingFn):
                         by the Evidence Variables (thus removing these
                         variables) before you compute an elimination 
                         ordering of the remaining variables.
+           log_space---optional. If True the factors are multiplied and
+                       summed in log space (see Factor), so that the
+                       products of many small probabilities do not
+                       underflow to 0. Defaults to Net.log_space.
 
 
     VE returns a distribution over the values of QueryVar, i.e., a list
@@ -420,141 +838,389 @@ def VE(Net, QueryVar, EvidenceVars, orderingFn):
     mean that Pr(A='a'|B=1, C='c') = 0.5 Pr(A='a'|B=1, C='c') = 0.24
     Pr(A='a'|B=1, C='c') = 0.26
  
+    VE reads the evidence from the variables, so queries with different
+    evidence on the same variables cannot run at the same time (e.g., 
+    from several threads); use VE_query for that.
     '''
+    Evidence = dict([(var, var.get_evidence()) for var in EvidenceVars])
+    return VE_query(Net, QueryVar, Evidence, orderingFn, log_space)
+
+def VE_query(Net, QueryVar, Evidence, orderingFn, log_space=None):
+    '''Same as VE, but the evidence is passed in: Evidence is a 
+    dictionary mapping each evidence variable to its value, e.g.,
+        VE_query(bn, SE, {BQ: 'Optimal', AN: True}, min_fill_ordering)
+    The evidence set on the variables is not used or changed, so this
+    function can be called from several threads at once.'''
+    evidence = dict([(var, var.value_index(val)) for (var, val) in Evidence.items()])
+    EvidenceVars = evidence.keys()
+
+    ## Queries with no evidence, or evidence only on roots, are looked 
+    # up if the net keeps precomputed marginals
+    if QueryVar not in evidence:
+        marginals = Net.root_marginals(evidence)
+        if marginals is not None and QueryVar in marginals:
+            return list(marginals[QueryVar])
+
+    f = joint_factor(Net, QueryVar, evidence, orderingFn, log_space)
+    if f.get_scope() != [QueryVar]:
+        raise ValueError("Error in final factor. Scope: {}".format([v.name for v in f.get_scope()]))
+    
+    ## Normalize
+    return normalize(f.values, f.log_space)
+
+def VE_joint(Net, QueryVars, EvidenceVars, orderingFn, log_space=None):
+    '''Compute the joint distribution of the variables in QueryVars (a 
+    list) given the evidence set on EvidenceVars (as for VE). Returns a
+    factor over QueryVars (in that order) holding the probability of 
+    each of their joint assignments given the evidence, e.g.
+        joint = VE_joint(bn, [TM, TR], [SE, BQ], min_fill_ordering)
+        joint.get_value([True, False])
+    is Pr(TM=True, TR=False | SE, BQ). All the query variables are left
+    out of the elimination ordering (orderingFn is called with the list
+    QueryVars), so the joint is computed by a single elimination.'''
+    QueryVars = list(QueryVars)
+    evidence = dict([(var, var.evidence_index) for var in EvidenceVars])
+    f = joint_factor(Net, QueryVars, evidence, orderingFn, log_space)
+    if set(f.get_scope()) != set(QueryVars) or len(f.get_scope()) != len(QueryVars):
+        raise ValueError("Error in final factor. Scope: {}".format([v.name for v in f.get_scope()]))
+    
+    ## Normalize, with the axes in the order of QueryVars
+    values = align_values(f, QueryVars)
+    n_const = sum_values(values, None, f.log_space)
+    if f.log_space:
+        values = np.exp(values - n_const)
+    else:
+        values = values / n_const
+    return Factor(generate_factor_name(QueryVars), QueryVars, values)
+
+def joint_factor(Net, QueryVar, evidence, orderingFn, log_space=None):
+    '''Returns a factor over QueryVar (a variable, or a list of 
+    variables) proportional to its distribution given evidence (a 
+    dictionary mapping the evidence variables to the INDICES of their
+    values), by eliminating every other variable. This is the part of
+    VE before normalization.'''
+    EvidenceVars = evidence.keys()
 
     ## Replace each factor f in F that mentions a variable(s) in EvidenceVars
-    # with its restriction factor (this might yield a 'constant' factor)
-    factors = list() # list to contain the factors after restriction step
-    for factor in Net.factors():
+    # with its restriction factor (this might yield a 'constant' factor).
+    # Factors that cannot affect the answer are skipped.
+    factors = restrict_factors(relevant_factors(Net, QueryVar, EvidenceVars), evidence)
+    
+    if log_space is None:
+        log_space = Net.log_space
+    if log_space:
+        factors = [f.to_log_space() for f in factors]
+    
+    ## Get an ordering of variables for elimination
+    # (cached on the net for this query variable and evidence set)
+    order = Net.elimination_ordering(factors, QueryVar, EvidenceVars, orderingFn)
+    
+    ## Eliminate variables in order
+    factors = sum_out_in_order(factors, order)
+    
+    ## Multiply the remaining factors. Constant factors are left out,
+    # they only scale the result.
+    prod_list = [f for f in factors if f.get_scope()]
+    if not prod_list:
+        return Factor('', [], 0.0 if log_space else 1.0, log_space)
+    return create_product_factor(prod_list, None)
+    
+def MAP(Net, MapVars, EvidenceVars, orderingFn, log_space=None):
+    '''Find the most probable joint assignment to the variables in 
+    MapVars given the evidence set on EvidenceVars (as for VE):
+        (assignment, probability) = MAP(bn, [TM, BQ, SE], [EEG_SIG, EMG],
+                                        min_fill_ordering)
+    returns a dictionary mapping each variable in MapVars to its value 
+    in the most probable assignment, and the probability of that 
+    assignment given the evidence. MapVars must not contain evidence 
+    variables.
+
+    This is max-product variable elimination: the other non-evidence 
+    variables are summed out first, then the MAP variables are 
+    maximized out (both in the order orderingFn gives them), and for
+    every maximized variable the value giving the maximum is kept for 
+    each assignment to the rest of its product's scope. The assignment
+    is then traced back from the last maximized variable to the first.
+    Summing out the MAP variables instead gives the probability of the
+    evidence, by which the maximum is normalized.
+    If log_space is set (it defaults to Net.log_space) the computation
+    is done in log space.'''
+    for var in MapVars:
+        if var in EvidenceVars:
+            raise ValueError("MAP variable {} has evidence".format(var.name))
+    evidence = dict([(var, var.evidence_index) for var in EvidenceVars])
+    factors = restrict_factors(relevant_factors(Net, list(MapVars), EvidenceVars), evidence)
+    if log_space is None:
+        log_space = Net.log_space
+    if log_space:
+        factors = [f.to_log_space() for f in factors]
+    
+    ## Sum out the variables that are not MAP variables
+    maximized = set(MapVars)
+    order = orderingFn(factors, None)
+    factors = sum_out_in_order(factors, [v for v in order if v not in maximized])
+    order = [v for v in order if v in maximized]
+    
+    ## Maximize out the MAP variables, keeping the argmax tables
+    maxed = factors
+    traceback = []
+    for var in order:
+        prod_list = [f for f in maxed if var in f.get_scope()]
+        (f, argmax) = max_out_product(prod_list, var)
+        traceback.append((var, f.get_scope(), argmax))
+        maxed = [x for x in maxed if x not in prod_list] + [f]
+    
+    ## Trace the assignment back, last maximized variable first: the 
+    # scope of each argmax table was maximized after it
+    index = dict()
+    for (var, scope, argmax) in reversed(traceback):
+        index[var] = argmax[tuple([index[v] for v in scope])]
+    assignment = dict([(var, var.domain()[index[var]]) for var in MapVars])
+    
+    ## Normalize by the probability of the evidence: what is left when 
+    # the MAP variables are summed out instead. (Every variable has been
+    # eliminated, so only constant factors are left.)
+    def constant(factors):
+        (factors, log_space) = same_space(factors)
+        values = [f.values for f in factors]
+        return (np.sum(values) if log_space else np.prod(values), log_space)
+    (maximum, log_space) = constant(maxed)
+    (total, log_space) = constant(sum_out_in_order(factors, order))
+    if log_space:
+        probability = np.exp(maximum - total)
+    else:
+        probability = maximum / total
+    return (assignment, float(probability))
+
+def MPE(Net, EvidenceVars, orderingFn, log_space=None):
+    '''Find the most probable explanation of the evidence: the most 
+    probable joint assignment to ALL the variables of Net that have no
+    evidence. Returns (assignment, probability) as MAP does.'''
+    hidden = [v for v in Net.variables() if v not in EvidenceVars]
+    return MAP(Net, hidden, EvidenceVars, orderingFn, log_space)
+
+def restrict_factors(factors, evidence):
+    '''Returns the factors restricted by evidence, a dictionary mapping 
+    variables to the INDICES of their values. Constant factors are left
+    out; factors that mention no evidence variable are kept as they are.'''
+    restricted = list()
+    for factor in factors:
         scope = factor.get_scope()
         if not scope:
             # Constrant factor. Nothing to restrict
             continue
         
         # Apply restriction, if needed
-        restrictions = [var for var in scope if var in EvidenceVars]
+        restrictions = [var for var in scope if var in evidence]
         if restrictions:
             # Add restricted factor 
-            factors.append(factor.get_restricted_factor(restrictions))
+            restricted.append(factor.get_restricted_factor(restrictions, evidence))
         else:
             # Add the original factor
-            factors.append(factor)
-    
-    ## Get an ordering of variables for elimination
-    order = orderingFn(factors, QueryVar)
-    
-    ## Eliminate variables in order
+            restricted.append(factor)
+    return restricted
+
+def sum_out_in_order(factors, order):
+    '''Eliminates the variables in order from the list of factors by 
+    summing, one at a time. Returns the list of remaining factors.'''
     for var in order:
         # Create list of factors that have 'var' in their scope
         prod_list = [f for f in factors if var in f.get_scope()]
-        # Create product of factors, if needed
-        product = None
+        # Eliminate var by summing
         if len(prod_list) == 1:
-            product = prod_list[0]
+            summed = eliminate_var(prod_list[0], var)
         elif len(prod_list) > 1:
-            # Create a product factor
-            product = create_product_factor(prod_list, var)
+            # Multiply and sum in one step, without building the product
+            summed = sum_out_product(prod_list, var)
         else:
             continue
-        # Eliminate var by summing
-        summed = eliminate_var(product, var)
         # Eliminate factors containing var and add the summed factor
         factors = [x for x in factors if x not in prod_list] + [summed]
-    
-    ## Factor the factors containing QueryVar
-    prod_list = [f for f in factors if QueryVar in f.get_scope()]
-    f = create_product_factor(prod_list, QueryVar)
-    factors = [x for x in factors if x not in prod_list] + [f]
-    
-    ## Normalize
-    # Get normalization const
-    n_const = 0
-    assignments = generate_assignments(f.get_scope(), None)
-    for a in assignments:
-        n_const += f.get_value(a)
-    # Set normalized values
-    if (n_const != 1):
-        for a in assignments:
-            a.append(f.get_value(a)/n_const)
-            f.add_values([a])
-    
-    if len(f.get_scope()) != 1:
-        print 'Error in final factor. Scope: ', f.get_scope()
-        exit(-1)
-    else:
-        distribution = [f.get_value(a) for a in generate_assignments(f.scope, None)]
-        return distribution
-    
+    return factors
+
 def eliminate_var(factor, var):
     '''Eliminates the given var from the factor by summing.
     Returns a newe factor with var removed from its scope. 
     This operation might result in constant factor, where len(scope) is 0'''
-    # Create new factor to contain the values after elimination
     new_scope = [x for x in factor.get_scope() if x is not var]
-    new_factor = Factor(generate_factor_name(new_scope), new_scope)
-    assignments = generate_assignments(new_scope, None)
-    # Index of 'var' in factor's scope
-    var_index = factor.get_scope().index(var)
-    # Add values to new factor using the generated assignemnts
-    for i in range(0, len(assignments)):
-        # Get new assignment value by summing over all possible values
-        # in var's domain 
-        t = 0 
-        for val in var.domain(): 
-            a = assignments[i][0:var_index] + [val] + assignments[i][var_index:len(assignments)]
-            t += factor.get_value(a) 
-        # Concatenate the sum to the assignment so that it can be 
-        # used to call new_factor.add_values()
-        assignments[i].append(t)
-    # Store the values in new_factor
-    new_factor.add_values(assignments)
-    return new_factor
+    # Sum the table along the axis of 'var'
+    values = sum_values(factor.values, factor.scope.index(var), factor.log_space)
+    return Factor(generate_factor_name(new_scope), new_scope, values, factor.log_space)
+
+def eliminate_vars(factor, vars):
+    '''Eliminates all the variables in vars from the factor by summing.
+    Returns a new factor over the remaining variables of its scope'''
+    new_scope = [x for x in factor.get_scope() if x not in vars]
+    axes = tuple([i for (i, x) in enumerate(factor.scope) if x in vars])
+    if axes:
+        values = sum_values(factor.values, axes, factor.log_space)
+    else:
+        values = factor.values
+    return Factor(generate_factor_name(new_scope), new_scope, values, factor.log_space)
+
+def normalize(values, log_space=False):
+    '''Returns the table 'values' divided by the sum of its values, as a
+    list (a new one: values may be the table of one of the Net's own 
+    factors). In log space the table holds logs; the result does not.'''
+    n_const = sum_values(values, None, log_space)
+    if log_space:
+        return np.exp(values - n_const).tolist()
+    return (values / n_const).tolist()
+
+def sum_values(values, axis, log_space=False):
+    '''Sum a table along the given axis (or tuple of axes). In log space
+    the table holds logs, and the log of the sum is computed 
+    (log-sum-exp, shifted by the maximum so that it cannot underflow)'''
+    if not log_space:
+        return values.sum(axis=axis)
+    shift = np.max(values, axis=axis, keepdims=True)
+    shift[~np.isfinite(shift)] = 0
+    with np.errstate(divide='ignore'):
+        summed = np.log(np.exp(values - shift).sum(axis=axis))
+    return summed + np.squeeze(shift, axis=axis)
+
+def sum_out_product(factors, var):
+    '''Returns the factor obtained by multiplying 'factors' and summing 
+    out var, i.e., eliminate_var(create_product_factor(factors, var), var),
+    without materializing the product factor. The product is built one 
+    value of var at a time and accumulated, so at most two tables of the
+    size of the result are allocated.'''
+    (factors, log_space) = same_space(factors)
+    var_factors = [f for f in factors if var in f.get_scope()]
+    other_factors = [f for f in factors if var not in f.get_scope()]
+    new_scope = [x for x in product_scope(factors) if x is not var]
+    shape = [x.domain_size() for x in new_scope]
+    values = np.empty(shape, dtype=np.float64)
+    values.fill(-np.inf if log_space else 0)
+    term = np.empty(shape, dtype=np.float64)
+    for k in range(var.domain_size()):
+        # Slice every factor at var = k-th value and multiply the slices
+        multiply_into([slice_factor(f, var, k) for f in var_factors],
+                      new_scope, term, log_space)
+        if log_space:
+            np.logaddexp(values, term, out=values)
+        else:
+            values += term
+    for f in other_factors:
+        if log_space:
+            values += align_values(f, new_scope)
+        else:
+            values *= align_values(f, new_scope)
+    return Factor(generate_factor_name(new_scope), new_scope, values, log_space)
+
+def max_out_product(factors, var):
+    '''Returns (factor, argmax): the factor obtained by multiplying 
+    'factors' and maximizing over var, and an array over the factor's
+    scope holding, for each assignment, the index of the value of var 
+    that gives the maximum (the first one, on ties). Like 
+    sum_out_product, the product is built one value of var at a time.'''
+    (factors, log_space) = same_space(factors)
+    var_factors = [f for f in factors if var in f.get_scope()]
+    other_factors = [f for f in factors if var not in f.get_scope()]
+    new_scope = [x for x in product_scope(factors) if x is not var]
+    shape = [x.domain_size() for x in new_scope]
+    values = np.empty(shape, dtype=np.float64)
+    values.fill(-np.inf)
+    argmax = np.zeros(shape, dtype=np.intp)
+    term = np.empty(shape, dtype=np.float64)
+    for k in range(var.domain_size()):
+        multiply_into([slice_factor(f, var, k) for f in var_factors],
+                      new_scope, term, log_space)
+        better = term > values
+        np.copyto(values, term, where=better)
+        argmax[better] = k
+    for f in other_factors:
+        if log_space:
+            values += align_values(f, new_scope)
+        else:
+            values *= align_values(f, new_scope)
+    return (Factor(generate_factor_name(new_scope), new_scope, values, log_space), argmax)
+
+def slice_factor(factor, var, index):
+    '''Returns the factor (a view on the table of 'factor') obtained by
+    fixing var to the value at position 'index' of its domain'''
+    axis = factor.scope.index(var)
+    new_scope = factor.scope[:axis] + factor.scope[axis+1:]
+    values = factor.values[(slice(None),)*axis + (index,)]
+    return Factor(factor.name, new_scope, values, factor.log_space)
 
 def create_product_factor(factors, cvar):
     '''Returns a factor that is the product of the 'factors' given the 
-    common variable 'cvar'
+    common variable 'cvar'.
+    The whole list is multiplied in one pass: each factor's table is
+    aligned to the product's scope and the tables are multiplied by
+    broadcasting into a single output table, so no intermediate
+    products are materialized. If any of the factors is in log space,
+    so is the product (the logs are added).
     ''' 
-    # Create product using two factors at a time
-    factor1 = factors[0]
-    for factor2 in factors[1:]:
-        factor1 = product_helper(factor1, factor2)
-    return factor1
+    if len(factors) == 1:
+        return factors[0]
+    (factors, log_space) = same_space(factors)
+    new_scope = product_scope(factors)
+    values = np.empty([var.domain_size() for var in new_scope], dtype=np.float64)
+    multiply_into(factors, new_scope, values, log_space)
+    return Factor('_x_'.join([f.name for f in factors]), new_scope, values, log_space)
     
 def product_helper(factor1, factor2): 
     '''Creates product of factor1 and factor2. 
     These factors can have one or many variables in common.'''
-    # Create the product factor
-    # Notice the ordering of the new_scope variables
-    # This is crucial in the step where we set the values in the table
-    new_scope = [var for var in factor1.get_scope()]
-    new_scope = new_scope + [var for var in factor2.get_scope() if var not in factor1.get_scope()]
-    product = Factor(factor1.name + '_x_' + factor2.name, new_scope)
-    
-    # List of variables that are common in both factors
-    cvars = [var for var in factor1.get_scope() if var in factor2.get_scope()]
-    # Create list of possible assignment combinations for the common variables
-    restricted_assignments = generate_assignments(cvars, None) 
-    
-    # Add values to the new factor
-    for ra in restricted_assignments:
-        # Assign values from this restriction to the common vars
-        for i in range(0,len(cvars)):
-            cvars[i].set_assignment(ra[i])
-        # Generate assignments for the given factors. 
-        # These will be used to lookup values.
-        assignments1 = generate_assignments(factor1.get_scope(), cvars, 'assignment')
-        assignments2 = generate_assignments(factor2.get_scope(), cvars, 'assignment')
-        # Calculate and add new values
-        for a1 in assignments1:
-            for a2 in assignments2:
-                # Find indices of the common vars in factor 2
-                common_indices2 = [factor2.scope.index(var) for var in cvars]
-                value = None # Argument for product.add_values(*) call
-                value = a1 + [a2[i] for i in range(0, len(a2)) if i not in common_indices2] 
-                #value += [var for (i,var) in a2 if i not in common_indices2] 
-                value += [factor1.get_value(a1) * factor2.get_value(a2)]
-                product.add_values([value])
-    return product  
+    return create_product_factor([factor1, factor2], None)
+
+def same_space(factors):
+    '''Returns the factors converted to log space if any of them is in 
+    log space, along with a flag telling if they are'''
+    log_space = any([f.log_space for f in factors])
+    if log_space:
+        factors = [f.to_log_space() for f in factors]
+    return (factors, log_space)
+
+def product_scope(factors):
+    '''Returns the scope of the product of the given factors: the
+    variables of the first factor in order, followed by the variables
+    of each next factor that have not been seen yet'''
+    new_scope = []
+    seen = set()
+    for f in factors:
+        for var in f.get_scope():
+            if var not in seen:
+                seen.add(var)
+                new_scope.append(var)
+    return new_scope
+
+def multiply_into(factors, scope, out, log_space=False):
+    '''Stores the product of 'factors' in the array 'out', a table over
+    'scope' (the union of the factors' scopes, in any order)'''
+    return multiply_arrays([align_values(f, scope) for f in factors], out, log_space)
+
+def multiply_arrays(arrays, out, log_space=False):
+    '''Stores the (broadcast) product of a list of arrays in 'out'. In 
+    log space the arrays hold logs, and are added instead.'''
+    op = np.add if log_space else np.multiply
+    if len(arrays) == 1:
+        out[...] = arrays[0]
+        return out
+    op(arrays[0], arrays[1], out=out)
+    for a in arrays[2:]:
+        op(out, a, out=out)
+    return out
+
+def align_values(factor, scope):
+    '''Returns the factor's table as a view that broadcasts against a 
+    table over 'scope' (which must contain the factor's scope): its axes
+    are reordered to follow 'scope' and the variables it does not
+    mention get axes of length 1.'''
+    (order, shape) = alignment(factor.scope, scope)
+    return factor.values.transpose(order).reshape(shape)
+
+def alignment(table_scope, scope):
+    '''Returns the (axes order, shape) pair used by align_values to make
+    a table over table_scope broadcast against a table over scope'''
+    positions = [scope.index(var) for var in table_scope]
+    order = sorted(range(len(positions)), key=lambda i: positions[i])
+    shape = [1]*len(scope)
+    for var, pos in zip(table_scope, positions):
+        shape[pos] = var.domain_size()
+    return (order, shape)
     
 def generate_assignments(scope, restrictions, source = 'evidence'): 
     '''Generate possible assignments of values given a scope (list of vars) and 
@@ -563,40 +1229,1334 @@ def generate_assignments(scope, restrictions, source = 'evidence'):
     in a restriction variable. By default, looks into evidence to find the 
     restricted value.
     If no restriction given then just generates all possible value combinations
-    Returns list of lists containing assigned vales for each variable in the 
-    scope (in order)
+    Lazily yields lists containing assigned vales for each variable in the 
+    scope (in order). Use generate_index_assignments when only the domain
+    indices are needed.
     '''
-    # Generate list of possible assignments
-    # where restricted variables only take the evidence values
-    # while others take all values in their domains
-    assignments = list()
-    assignments.append([])
+    domains = [var.domain() for var in scope]
+    for index in generate_index_assignments(scope, restrictions, source):
+        yield [dom[i] for (dom, i) in zip(domains, index)]
+
+def generate_index_assignments(scope, restrictions=None, source = 'evidence'):
+    '''Same as generate_assignments, but lazily yields tuples of domain 
+    indices (one for each variable in the scope) instead of values. 
+    Assignments are generated in the order of a factor's table over
+    scope: the last variable changes fastest.'''
+    ranges = []
     for var in scope:
-        new_assignments = list()
-        while len(assignments) > 0:
-            old_tuple = assignments.pop(0)
-            if restrictions and var in restrictions:
-                # If a restricted variable, 
-                # generate just one assignment for it (the restriction)
-                tmp = old_tuple[:]
-                if source == 'evidence':
-                    tmp.append(restrictions[restrictions.index(var)]
-                           .get_evidence())
-                else: 
-                    tmp.append(restrictions[restrictions.index(var)]
-                           .get_assignment())
-                new_assignments.append(tmp)
+        if restrictions and var in restrictions:
+            # Restricted variables only take the evidence/assigned value
+            if source == 'evidence':
+                ranges.append((var.evidence_index,))
             else:
-                # Otherwise generate all possible assignments 
-                # of this variable
-                for val in var.domain():
-                    tmp = old_tuple[:]
-                    tmp.append(val)
-                    new_assignments.append(tmp)
-        assignments = new_assignments
-    return assignments
+                ranges.append((var.assignment_index,))
+        else:
+            ranges.append(xrange(var.domain_size()))
+    return itertools.product(*ranges)
+
+def generate_flat_offsets(scope, restrictions=None, source = 'evidence'):
+    '''Same as generate_index_assignments, but lazily yields the position
+    of each assignment in a flattened (row major) table over scope.'''
+    strides = []
+    stride = 1
+    for var in reversed(scope):
+        strides.insert(0, stride)
+        stride *= var.domain_size()
+    for index in generate_index_assignments(scope, restrictions, source):
+        yield sum([i*st for (i, st) in zip(index, strides)])
 
 def generate_factor_name(scope):
     '''Generates factor name from the list of scope variables'''
     return 'f' + str([x.name for x in scope])
 
+
+###############################################################################
+# Compiled queries
+###############################################################################
+
+def compile_query(Net, QueryVar, EvidenceVars, orderingFn, log_space=None):
+    '''Compile the VE query for QueryVar given EvidenceVars into a 
+    QueryPlan. The plan can then be run for any evidence values, e.g.:
+        plan = compile_query(bn, SE, [BQ, AN], min_fill_ordering)
+        plan.run(['Optimal', True])
+        plan.run(['Optimal', False])
+    returns the same distributions as VE(bn, SE, [BQ, AN], ...) after
+    setting the evidence of BQ and AN to these values.
+    If log_space is set (it defaults to Net.log_space) the plan computes
+    in log space, like VE.'''
+    return QueryPlan(Net, QueryVar, EvidenceVars, orderingFn, log_space)
+
+def VE_batch(Net, QueryVar, EvidenceVars, EvidenceRows, orderingFn, log_space=None):
+    '''Batched version of VE. EvidenceRows is a 2-D array (or list of 
+    lists) of evidence INDICES with one row per case and one column for
+    each variable in EvidenceVars: EvidenceRows[r][j] is the index in
+    EvidenceVars[j].domain() of its value in case r. 
+    Returns a 2-D array with one row per case; row r is the 
+    distribution over the values of QueryVar given the evidence of 
+    case r (what VE would return for it). The evidence set on the 
+    variables is not used or changed.'''
+    plan = compile_query(Net, QueryVar, EvidenceVars, orderingFn, log_space)
+    return plan.run_batch(EvidenceRows)
+
+class QueryPlan:
+    '''A VE query with a fixed query variable and a fixed list of 
+    evidence variables, compiled once. All the work of VE that does not
+    depend on the evidence values (which axes of which factors are 
+    restricted, the elimination ordering, which tables are multiplied 
+    at each elimination step, and how their axes line up) is done when
+    the plan is built. The result tables of the elimination steps are 
+    allocated once too, so running the plan is pure array arithmetic.
+
+    Every table the plan computes carries a leading batch axis, with one
+    entry per evidence row (or length 1 for the tables that do not 
+    depend on the evidence), so a whole batch of cases is answered by 
+    the same sequence of array operations (see run_batch).
+
+    The plan refers to the factors of the net; changes to their values
+    are seen by later runs, changes to the net's structure are not.
+    A plan can be run from several threads at once (each thread gets 
+    its own result tables).'''
+    
+    def __init__(self, Net, QueryVar, EvidenceVars, orderingFn, log_space=None):
+        self.QueryVar = QueryVar
+        self.EvidenceVars = list(EvidenceVars)
+        self.log_space = Net.log_space if log_space is None else log_space
+        
+        ## Restriction: for each factor, the axes order that puts its
+        # restricted axes first, and the columns of the evidence rows
+        # that index them
+        self.inputs = []
+        factors = []
+        batched = []
+        for factor in relevant_factors(Net, QueryVar, self.EvidenceVars):
+            scope = factor.get_scope()
+            restrictions = [var for var in scope if var in self.EvidenceVars]
+            axes = ([scope.index(var) for var in restrictions] +
+                    [i for (i, var) in enumerate(scope) if var not in restrictions])
+            columns = [self.EvidenceVars.index(var) for var in restrictions]
+            self.inputs.append((factor, axes, columns))
+            batched.append(bool(restrictions))
+            if restrictions:
+                factors.append(factor.get_restricted_factor(restrictions))
+            else:
+                factors.append(factor)
+        
+        order = Net.elimination_ordering(factors, QueryVar, self.EvidenceVars, orderingFn)
+        
+        ## Elimination steps. Tables are numbered in the order they are
+        # produced: first the restricted factors, then one per step.
+        scopes = [f.get_scope() for f in factors]
+        live = range(len(scopes))
+        self.steps = []
+        for var in order:
+            bucket = [i for i in live if var in scopes[i]]
+            if not bucket:
+                continue
+            new_scope = []
+            for i in bucket:
+                new_scope += [x for x in scopes[i] if x is not var and x not in new_scope]
+            # Each input is sliced along the axis of var, then aligned
+            # to the scope of the result (axis 0 is the batch axis)
+            inputs = []
+            for i in bucket:
+                axis = scopes[i].index(var)
+                sliced_scope = scopes[i][:axis] + scopes[i][axis+1:]
+                (perm, shape) = alignment(sliced_scope, new_scope)
+                inputs.append((i, (slice(None),)*(axis+1), 
+                               [0] + [p+1 for p in perm], [-1] + shape))
+            batched.append(any([batched[i] for i in bucket]))
+            self.steps.append((inputs, var.domain_size(), 
+                               [x.domain_size() for x in new_scope], batched[-1]))
+            live = [i for i in live if i not in bucket] + [len(scopes)]
+            scopes.append(new_scope)
+        
+        ## The remaining tables are over QueryVar or constant
+        final = []
+        for i in live:
+            if scopes[i] == [QueryVar]:
+                final.append(i)
+            elif scopes[i]:
+                raise ValueError("Error in final factor. Scope: {}".format(scopes[i]))
+        if not final:
+            raise ValueError("{} is not in the scope of the net's factors".format(QueryVar))
+        self.final = final
+        
+        # Step result tables for single queries, one set per thread
+        self.local = threading.local()
+        self.local.buffers = self.allocate(1)
+    
+    def allocate(self, batch_size):
+        '''Allocate the result table of each step for a batch of the given
+        size, plus a scratch table large enough for the biggest step'''
+        sizes = []
+        for (inputs, size, shape, batched) in self.steps:
+            sizes.append(int(np.prod(shape)) * (batch_size if batched else 1))
+        scratch = np.empty(max([1] + sizes))
+        buffers = []
+        for ((inputs, size, shape, batched), n) in zip(self.steps, sizes):
+            shape = [batch_size if batched else 1] + shape
+            buffers.append((np.empty(shape), scratch[:n].reshape(shape)))
+        return buffers
+    
+    def run(self, evidence_values=None):
+        '''Run the plan and return the distribution over the values of
+        QueryVar (a list, like VE). evidence_values is a list with one
+        value for each evidence variable (in the order they were given 
+        to compile_query). If it is not given, the evidence values set 
+        on the evidence variables are used.'''
+        if evidence_values is None:
+            indices = [var.evidence_index for var in self.EvidenceVars]
+        else:
+            indices = [var.value_index(val) for (var, val) in zip(self.EvidenceVars, evidence_values)]
+        return self.run_indices(indices)
+
+    def run_indices(self, evidence_indices):
+        '''Same as run, but the evidence is given as indices into the
+        domains of the evidence variables'''
+        rows = np.array([evidence_indices], dtype=np.intp)
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            buffers = self.local.buffers = self.allocate(1)
+        return self.evaluate(rows, buffers)[0].tolist()
+
+    def run_batch(self, evidence_rows, chunk_size=4096):
+        '''Run the plan on many cases at once. evidence_rows is a 2-D 
+        array of evidence indices, one row per case (see VE_batch).
+        Returns a 2-D array of distributions, one row per case. Rows 
+        are processed chunk_size at a time, which bounds the size of 
+        the intermediate tables.'''
+        rows = np.atleast_2d(np.asarray(evidence_rows, dtype=np.intp))
+        result = np.empty((rows.shape[0], self.QueryVar.domain_size()))
+        buffers = None
+        for start in range(0, rows.shape[0], chunk_size):
+            chunk = rows[start:start+chunk_size]
+            if buffers is None or len(chunk) != chunk_size:
+                buffers = self.allocate(len(chunk))
+            result[start:start+len(chunk)] = self.evaluate(chunk, buffers)
+        return result
+
+    def evaluate(self, rows, buffers):
+        '''Compute the (normalized) distributions for a 2-D array of
+        evidence indices using the given step buffers'''
+        log_space = self.log_space
+        tables = []
+        for (factor, axes, columns) in self.inputs:
+            if columns:
+                index = tuple([rows[:, c] for c in columns])
+                table = factor.values.transpose(axes)[index]
+            else:
+                table = factor.values[np.newaxis]
+            if log_space and not factor.log_space:
+                with np.errstate(divide='ignore'):
+                    table = np.log(table)
+            elif factor.log_space and not log_space:
+                table = np.exp(table)
+            tables.append(table)
+        for ((inputs, size, shape, batched), (out, term)) in zip(self.steps, buffers):
+            out.fill(-np.inf if log_space else 0)
+            for k in range(size):
+                multiply_arrays([tables[i][lead + (k,)].transpose(perm).reshape(shape)
+                                 for (i, lead, perm, shape) in inputs], term, log_space)
+                if log_space:
+                    np.logaddexp(out, term, out=out)
+                else:
+                    out += term
+            tables.append(out)
+        values = np.zeros((len(rows), self.QueryVar.domain_size()))
+        if log_space:
+            for i in self.final:
+                values += tables[i]
+            return np.exp(values - sum_values(values, 1, True)[:, np.newaxis])
+        values += 1
+        for i in self.final:
+            values *= tables[i]
+        return values / values.sum(axis=1)[:, np.newaxis]
+
+
+###############################################################################
+# Junction tree
+###############################################################################
+
+class JunctionTree:
+    '''A junction tree (clique tree) of a Bayes net, used to compute the
+    posterior marginals of ALL the net's variables given some evidence
+    with two passes of messages instead of one VE run per variable.
+
+    The tree is built by triangulating the net with an elimination 
+    ordering: jt = JunctionTree(bn, min_fill_ordering) (orderingFn is
+    called with QueryVar = None so that every variable is ordered). 
+    Eliminating a variable creates a clique made of it and its
+    neighbors; the clique is linked to the clique of the first of those
+    neighbors to be eliminated, and cliques contained in a neighboring 
+    clique are merged into it. Every factor of the net is assigned to
+    a clique containing its scope.
+
+    Inference uses Shafer-Shenoy message passing. The message from
+    clique i to its neighbor j is the product of i's potential (its 
+    factors times the evidence indicators of its variables) and the 
+    messages i receives from its other neighbors, summed down to the
+    variables i and j share. Messages are computed when they are first
+    needed and kept until the evidence they depend on changes:
+        jt.calibrate([AN, MD])   # evidence values set with set_evidence
+        jt.marginal(SE)          # distribution over SE.domain()
+        jt.marginals()           # {variable: distribution}
+
+    If log_space is set (it defaults to Net.log_space) the potentials 
+    and messages are computed in log space, like VE. The factors of the
+    net are assigned to the cliques in the space the tree works in (a 
+    converted copy of those stored in the other space).
+    '''
+
+    def __init__(self, Net, orderingFn, log_space=None):
+        if log_space is None:
+            log_space = Net.log_space
+        self.log_space = log_space
+        factors = [f.to_log_space() if log_space else f.to_linear_space()
+                   for f in Net.factors() if f.get_scope()]
+        order = orderingFn(factors, None)
+        position = dict([(v, i) for (i, v) in enumerate(order)])
+        (graph, Vars) = interaction_graph(factors)
+        
+        ## One clique per eliminated variable, linked to the clique of 
+        # its first eliminated neighbor
+        cliques = []
+        parent = []
+        for var in order:
+            neighbors = graph.pop(var)
+            for n in neighbors:
+                graph[n].discard(var)
+                graph[n].update(neighbors)
+                graph[n].discard(n)
+            cliques.append([var] + sorted(neighbors, key=lambda n: position[n]))
+            parent.append(min([position[n] for n in neighbors]) if neighbors else None)
+        
+        ## Merge each clique that is contained in one of its children 
+        # into that child. Children always come first in the order.
+        alias = range(len(cliques))
+        children = [[] for c in cliques]
+        for (i, p) in enumerate(parent):
+            if p is not None:
+                children[p].append(i)
+        for j in range(len(cliques)):
+            for i in children[j]:
+                if set(cliques[j]) <= set(cliques[i]):
+                    alias[j] = i
+                    parent[i] = parent[j]
+                    if parent[j] is not None:
+                        children[parent[j]].remove(j)
+                        children[parent[j]].append(i)
+                    for c in children[j]:
+                        if c != i:
+                            parent[c] = i
+                            children[i].append(c)
+                    break
+        
+        keep = [i for i in range(len(cliques)) if alias[i] == i]
+        number = dict([(old, new) for (new, old) in enumerate(keep)])
+        self.cliques = [cliques[i] for i in keep]
+        self.neighbors = [[] for c in self.cliques]
+        for i in keep:
+            if parent[i] is not None:
+                self.neighbors[number[i]].append(number[parent[i]])
+                self.neighbors[number[parent[i]]].append(number[i])
+        
+        ## Assign each factor to the clique of the first eliminated
+        # variable of its scope (that clique contains the whole scope)
+        def clique_of(var):
+            i = position[var]
+            while alias[i] != i:
+                i = alias[i]
+            return number[i]
+        self.assigned = [[] for c in self.cliques]
+        for f in factors:
+            first = min(f.get_scope(), key=lambda v: position[v])
+            self.assigned[clique_of(first)].append(f)
+        
+        # Each variable is looked up (and its evidence entered) in the
+        # smallest clique containing it
+        self.home = dict()
+        for (i, clique) in enumerate(self.cliques):
+            for v in clique:
+                if v not in self.home or len(clique) < len(self.cliques[self.home[v]]):
+                    self.home[v] = i
+        
+        self.evidence = dict()      # variable -> index of its evidence value
+        self.potentials = dict()    # clique -> potential (a Factor)
+        self.messages = dict()      # (from clique, to clique) -> message
+    
+    def variables(self):
+        '''Return the variables covered by the tree'''
+        return list(self.home.keys())
+
+    def calibrate(self, EvidenceVars):
+        '''Set the evidence to the current evidence values of the 
+        variables in EvidenceVars (and no other evidence), and pass all
+        the messages so that every marginal is then a local computation.'''
+        self.enter_evidence(dict([(var, var.evidence_index) for var in EvidenceVars]))
+        edges = self.collect_edges(range(len(self.cliques)))
+        for (child, parent) in edges:
+            self.message(child, parent)
+        for (child, parent) in reversed(edges):
+            self.message(parent, child)
+
+    def enter_evidence(self, evidence):
+        '''Set the evidence to the given one (and no other evidence): 
+        evidence is a dictionary mapping variables to the indices of 
+        their values'''
+        for var in self.evidence.keys():
+            if var not in evidence:
+                self.retract_evidence(var)
+        for (var, index) in evidence.items():
+            self.set_evidence(var, index)
+
+    def set_evidence(self, var, index):
+        '''Enter evidence var = var.domain()[index]. Only the potential 
+        of var's clique and the messages that depend on it are dropped; 
+        they are recomputed when a marginal needs them.'''
+        if self.evidence.get(var) != index:
+            self.evidence[var] = index
+            self.invalidate(self.home[var])
+
+    def retract_evidence(self, var):
+        '''Remove the evidence on var (if any)'''
+        if var in self.evidence:
+            del self.evidence[var]
+            self.invalidate(self.home[var])
+
+    def invalidate(self, i):
+        '''Drop the potential of clique i and every message sent away from
+        it. A missing message was never passed on, so the search stops 
+        at missing messages.'''
+        self.potentials.pop(i, None)
+        stack = [(i, None)]
+        while stack:
+            (u, previous) = stack.pop()
+            for w in self.neighbors[u]:
+                if w != previous and (u, w) in self.messages:
+                    del self.messages[(u, w)]
+                    stack.append((w, u))
+    
+    def marginal(self, var):
+        '''Return the distribution over the values of var given the 
+        evidence (a list, like VE)'''
+        i = self.home[var]
+        belief = self.belief(i)
+        values = eliminate_vars(belief, [v for v in self.cliques[i] if v is not var]).values
+        return normalize(values, self.log_space)
+    
+    def marginals(self):
+        '''Return a dictionary mapping every variable of the tree to its
+        distribution given the evidence'''
+        beliefs = dict()
+        result = dict()
+        for (var, i) in self.home.items():
+            if i not in beliefs:
+                beliefs[i] = self.belief(i)
+            values = eliminate_vars(beliefs[i], [v for v in self.cliques[i] if v is not var]).values
+            result[var] = normalize(values, self.log_space)
+        return result
+
+    def belief(self, i):
+        '''Return the product of clique i's potential and all its incoming
+        messages: a factor proportional to the joint distribution of the 
+        clique's variables and the evidence'''
+        for (child, parent) in self.collect_edges([i]):
+            self.message(child, parent)
+        factors = [self.potential(i)] + [self.messages[(k, i)] for k in self.neighbors[i]]
+        return create_product_factor(factors, None)
+
+    def collect_edges(self, roots):
+        '''Return the (child, parent) edges of the trees hanging from the 
+        given cliques (each clique is visited once), leaves first, so 
+        that passing messages along them in order collects every message
+        toward the roots'''
+        edges = []
+        visited = set()
+        for root in roots:
+            if root in visited:
+                continue
+            visited.add(root)
+            stack = [root]
+            while stack:
+                i = stack.pop()
+                for k in self.neighbors[i]:
+                    if k not in visited:
+                        visited.add(k)
+                        edges.append((k, i))
+                        stack.append(k)
+        edges.reverse()
+        return edges
+    
+    def potential(self, i):
+        '''Return the potential of clique i: the product of its factors 
+        and of the indicators of the evidence entered in it, as a factor 
+        over the clique'''
+        if i not in self.potentials:
+            scope = self.cliques[i]
+            values = np.empty([v.domain_size() for v in scope])
+            if self.assigned[i]:
+                multiply_into(self.assigned[i], scope, values, self.log_space)
+            else:
+                values.fill(0 if self.log_space else 1)
+            for (axis, var) in enumerate(scope):
+                if var in self.evidence and self.home[var] == i:
+                    index = (slice(None),)*axis
+                    value = values[index + (self.evidence[var],)].copy()
+                    values[index] = -np.inf if self.log_space else 0
+                    values[index + (self.evidence[var],)] = value
+            self.potentials[i] = Factor(generate_factor_name(scope), scope, values, self.log_space)
+        return self.potentials[i]
+
+    def message(self, i, j):
+        '''Return the message from clique i to its neighbor j, computing 
+        it (from the messages i receives from its other neighbors, which 
+        must be available) if needed'''
+        if (i, j) not in self.messages:
+            factors = [self.potential(i)] + [self.messages[(k, i)] for k in self.neighbors[i] if k != j]
+            product = create_product_factor(factors, None)
+            shared = self.cliques[j]
+            self.messages[(i, j)] = eliminate_vars(product, [v for v in self.cliques[i] if v not in shared])
+        return self.messages[(i, j)]
+
+
+class InferenceSession:
+    '''An inference session over a Bayes net, for evidence that arrives
+    (or is withdrawn) one finding at a time:
+        session = InferenceSession(bn, min_fill_ordering)
+        session.add_evidence(AN, False)
+        session.marginal(SE)
+        session.add_evidence(EEG_SIG, 'Periodic')
+        session.marginal(SE)
+        session.retract_evidence(AN)
+    The session keeps a junction tree of the net. A new finding only 
+    resets its variable's clique and the messages sent away from it, 
+    and a marginal only recomputes the messages on the paths from the 
+    changed cliques to the clique of the queried variable, so the cost
+    of each update follows the size of the change, not of the net.
+    The evidence of a session is its own: the evidence values set on 
+    the variables (with set_evidence) are not used or changed. 
+    log_space is passed on to the tree (see JunctionTree).'''
+
+    def __init__(self, Net, orderingFn, log_space=None):
+        self.tree = JunctionTree(Net, orderingFn, log_space)
+
+    def add_evidence(self, var, value):
+        '''Observe var = value (replacing any earlier finding on var)'''
+        self.tree.set_evidence(var, var.value_index(value))
+
+    def retract_evidence(self, var):
+        '''Withdraw the finding on var'''
+        self.tree.retract_evidence(var)
+
+    def evidence(self):
+        '''Return a dictionary mapping each observed variable to its value'''
+        return dict([(var, var.domain()[i]) for (var, i) in self.tree.evidence.items()])
+
+    def marginal(self, var):
+        '''Return the distribution over the values of var given the 
+        current findings (a list, like VE)'''
+        return self.tree.marginal(var)
+
+    def marginals(self):
+        '''Return a dictionary mapping every variable to its distribution
+        given the current findings'''
+        return self.tree.marginals()
+
+
+###############################################################################
+# Shared computation between queries
+###############################################################################
+
+class QueryEngine:
+    '''Answers VE queries on a net, reusing the intermediate factors of 
+    earlier queries:
+        engine = QueryEngine(bn, min_fill_ordering)
+        engine.query(SE, {EEG_SIG: 'Periodic', EMG: 'Normal'})
+        engine.query(TM, {EEG_SIG: 'Periodic', EMG: 'Normal'})
+    
+    Every query with the same SET of evidence variables eliminates its 
+    variables in the same order: one ordering of all the variables, 
+    with the query variable skipped. The factor made by eliminating a
+    variable is the sum, over all the variables eliminated so far in 
+    its making, of the product of the net's factors (restricted by the
+    evidence) it was made from. It is cached under those source factors
+    (with their versions, see Factor.version), the eliminated variables
+    and the evidence, in an LRU cache of cache_size factors. So the 
+    eliminations a query shares with earlier ones (e.g., all those 
+    before its query variable in the order, when the evidence is the 
+    same) are looked up instead of computed, much like the messages of
+    a bucket tree.
+    
+    The factors are not pruned per query (see relevant_factors), so 
+    that the same intermediate factors come up from query to query.
+    hits and misses count the cache lookups.'''
+
+    def __init__(self, Net, orderingFn, cache_size=1024, log_space=None):
+        self.net = Net
+        self.orderingFn = orderingFn
+        self.log_space = Net.log_space if log_space is None else log_space
+        self.cache = LRUCache(cache_size)
+        self.hits = 0
+        self.misses = 0
+
+    def query(self, QueryVar, Evidence):
+        '''Return the distribution of QueryVar given Evidence, a 
+        dictionary mapping each evidence variable to its value (like 
+        VE_query)'''
+        evidence = dict([(var, var.value_index(val)) for (var, val) in Evidence.items()])
+        evidence_key = frozenset(evidence.items())
+        
+        # Each entry is (factor, source factors, eliminated variables)
+        entries = []
+        for f in self.net.factors():
+            if not f.get_scope():
+                continue
+            restricted = restrict_factors([f], evidence)[0]
+            if self.log_space:
+                restricted = restricted.to_log_space()
+            entries.append((restricted, frozenset([(f, f.version)]), frozenset()))
+        order = self.net.elimination_ordering([e[0] for e in entries], None, 
+                                              evidence.keys(), self.orderingFn)
+        
+        for var in order:
+            if var is QueryVar:
+                continue
+            prod_list = [e for e in entries if var in e[0].get_scope()]
+            if not prod_list:
+                continue
+            sources = frozenset().union(*[e[1] for e in prod_list])
+            eliminated = frozenset([var]).union(*[e[2] for e in prod_list])
+            key = (sources, eliminated, evidence_key, self.log_space)
+            summed = self.cache.get(key)
+            if summed is None:
+                self.misses += 1
+                if len(prod_list) == 1:
+                    summed = eliminate_var(prod_list[0][0], var)
+                else:
+                    summed = sum_out_product([e[0] for e in prod_list], var)
+                self.cache.put(key, summed)
+            else:
+                self.hits += 1
+            entries = [e for e in entries if e not in prod_list] + [(summed, sources, eliminated)]
+        
+        prod_list = [e[0] for e in entries if QueryVar in e[0].get_scope()]
+        if not prod_list:
+            raise ValueError("Query variable {} is not in the net or has evidence".format(QueryVar.name))
+        f = create_product_factor(prod_list, None)
+        if f.get_scope() != [QueryVar]:
+            raise ValueError("Error in final factor. Scope: {}".format([v.name for v in f.get_scope()]))
+        return normalize(f.values, f.log_space)
+
+    def marginals(self, QueryVars, Evidence):
+        '''Return a dictionary mapping each variable in QueryVars to its 
+        distribution given Evidence'''
+        return dict([(var, self.query(var, Evidence)) for var in QueryVars])
+
+    def clear(self):
+        '''Drop the cached factors'''
+        self.cache.clear()
+
+
+###############################################################################
+# Approximate inference
+###############################################################################
+
+def likelihood_weighting(Net, QueryVar, EvidenceVars, num_samples=100000, 
+                         tolerance=None, batch_size=10000, seed=None, stats=None):
+    '''Estimate the distribution of QueryVar given EvidenceVars by 
+    likelihood weighting, for nets where VE is too expensive. 
+    Returns a list of numbers, one for every value in QueryVar's 
+    domain, like VE.
+
+    Samples are drawn in batches of batch_size (so memory does not grow
+    with the number of samples), visiting the variables in topological
+    order: each non-evidence variable is sampled from its CPT given the
+    sampled values of its parents, and each evidence variable is fixed 
+    to its evidence value and multiplies the sample's weight by its 
+    probability. Only the ancestors of QueryVar and of the evidence 
+    variables are sampled. 
+    At most num_samples samples are drawn. If tolerance is given, 
+    sampling stops as soon as the estimated standard error of every 
+    probability in the result is below it. seed seeds the random 
+    number generator. If stats is a dictionary, the number of samples
+    drawn is stored in it under 'samples'.'''
+    random = np.random.RandomState(seed)
+    needed = Net.ancestors([QueryVar] + list(EvidenceVars))
+    order = [var for var in Net.topological_order() if var in needed]
+    
+    # Tables of the CPTs, as probabilities
+    tables = dict()
+    for var in order:
+        cpt = Net.cpt(var)
+        if cpt is None:
+            raise ValueError("{} has no CPT in {}".format(var.name, Net.name))
+        tables[var] = cpt.to_linear_space()
+    
+    # Weighted counts of the values of QueryVar, along with the sums of 
+    # the squared weights (for the standard error). Weights are kept in
+    # log space and the sums are scaled by exp(-scale).
+    size = QueryVar.domain_size()
+    counts = np.zeros(size)
+    squares = np.zeros(size)
+    scale = -np.inf
+    drawn = 0
+    while drawn < num_samples:
+        n = min(batch_size, num_samples - drawn)
+        drawn += n
+        samples = dict()
+        log_weights = np.zeros(n)
+        for var in order:
+            cpt = tables[var]
+            parents = tuple([samples[p] for p in cpt.scope[1:]])
+            if var in EvidenceVars:
+                samples[var] = np.repeat(var.evidence_index, n)
+                with np.errstate(divide='ignore'):
+                    log_weights += np.log(cpt.values[(var.evidence_index,) + parents])
+            else:
+                # Row i holds the distribution of var given the parents'
+                # values in sample i
+                probs = cpt.values[(slice(None),) + parents]
+                probs = probs.T if parents else np.tile(probs, (n, 1))
+                cumulative = probs.cumsum(axis=1)
+                u = random.random_sample(n) * cumulative[:, -1]
+                samples[var] = np.minimum((cumulative <= u[:, np.newaxis]).sum(axis=1),
+                                          var.domain_size() - 1)
+        
+        top = log_weights.max()
+        if top == -np.inf:
+            continue
+        if top > scale:
+            counts *= np.exp(scale - top)
+            squares *= np.exp(2*(scale - top))
+            scale = top
+        weights = np.exp(log_weights - scale)
+        counts += np.bincount(samples[QueryVar], weights=weights, minlength=size)
+        squares += np.bincount(samples[QueryVar], weights=weights**2, minlength=size)
+        
+        if tolerance is not None:
+            total = counts.sum()
+            p = counts / total
+            variance = (squares*(1 - 2*p) + p**2*squares.sum()) / total**2
+            if np.sqrt(variance.max()) < tolerance:
+                break
+    if stats is not None:
+        stats['samples'] = drawn
+    return (counts / counts.sum()).tolist()
+
+def gibbs_sampling(Net, QueryVar, EvidenceVars, num_samples=100000, burn_in=1000, 
+                   thinning=1, chains=4, processes=None, seed=None):
+    '''Estimate the distribution of QueryVar given EvidenceVars by Gibbs
+    sampling. Unlike likelihood weighting this works well when the 
+    evidence is very unlikely a priori. Returns a list of numbers, one 
+    for every value in QueryVar's domain, like VE.
+
+    Each chain starts from a forward sample of the net (with the 
+    evidence variables fixed, redrawn if the evidence is impossible in
+    it) and then repeatedly resamples every non-evidence variable from 
+    its distribution given its Markov blanket, i.e., from the product 
+    of the (restricted) factors that mention it. As with any single 
+    variable Gibbs sampler, the chains may fail to mix when some CPTs 
+    are deterministic (e.g. an OR node). The factors of each variable 
+    are found once, up front, from the factors relevant to the query 
+    (see relevant_factors).
+    The first burn_in sweeps of each chain are discarded, then the 
+    value of QueryVar is counted every thinning sweeps until 
+    num_samples values have been counted over all chains.
+    
+    The chains are independent. They are split into groups run by a 
+    pool of 'processes' worker processes (default: one per chain, up to
+    the number of CPUs), and the counts of the groups are added up. 
+    Within a group, the chains are advanced together as arrays. seed 
+    seeds the random number generators (each group gets its own seed 
+    derived from it), so for a given seed the estimate depends on the
+    number of processes but not on how the pool schedules the groups.'''
+    model = gibbs_model(Net, QueryVar, EvidenceVars)
+    if processes is None:
+        processes = min(chains, multiprocessing.cpu_count())
+    processes = max(1, min(processes, chains))
+    
+    # Split the chains and the samples between the groups
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=processes)
+    per_chain = -(-num_samples // chains)
+    tasks = []
+    for g in range(processes):
+        group_chains = chains // processes + (1 if g < chains % processes else 0)
+        tasks.append((model, group_chains, per_chain, burn_in, thinning, seeds[g]))
+    if processes == 1:
+        counts = [run_gibbs_chains(tasks[0])]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            counts = pool.map(run_gibbs_chains, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    counts = np.sum(counts, axis=0)
+    return (counts / counts.sum()).tolist()
+
+def gibbs_model(Net, QueryVar, EvidenceVars):
+    '''Precompute what gibbs_sampling needs, using only plain numbers and
+    arrays (so that it can be sent to worker processes). Variables are 
+    numbered by their position in the returned list of variables. 
+    Returns a dictionary with:
+      sizes:    the domain size of each variable
+      evidence: (variable, evidence index) pairs
+      hidden:   the variables to sample, in topological order
+      forward:  for each hidden variable, its CPT as (table, parents) 
+                where the table's LAST axis is the variable's
+      blanket:  for each hidden variable, the list of its factors 
+                restricted by the evidence, as (table, other variables)
+                pairs where the table's LAST axis is the variable's
+      factors:  all the factors restricted by the evidence, as (table,
+                variables) pairs
+      query:    the number of QueryVar'''
+    factors = relevant_factors(Net, QueryVar, EvidenceVars)
+    in_model = set()
+    for f in factors:
+        in_model.update(f.get_scope())
+    in_model.add(QueryVar)
+    Vars = [v for v in Net.topological_order() if v in in_model]
+    number = dict([(v, i) for (i, v) in enumerate(Vars)])
+    
+    def last_axis(factor, var):
+        # The factor's table with var's axis moved last, and the numbers
+        # of the other variables of its scope
+        others = [v for v in factor.scope if v is not var]
+        axes = [factor.scope.index(v) for v in others] + [factor.scope.index(var)]
+        return (factor.values.transpose(axes), [number[v] for v in others])
+    
+    restricted = []
+    for f in factors:
+        restrictions = [v for v in f.get_scope() if v in EvidenceVars]
+        if restrictions:
+            f = f.get_restricted_factor(restrictions)
+        restricted.append(f.to_linear_space())
+    
+    hidden = [v for v in Vars if v not in EvidenceVars]
+    forward = []
+    blanket = []
+    for var in hidden:
+        forward.append(last_axis(Net.cpt(var).to_linear_space(), var))
+        blanket.append([last_axis(f, var) for f in restricted if var in f.get_scope()])
+    return {'sizes': [v.domain_size() for v in Vars],
+            'evidence': [(number[v], v.evidence_index) for v in EvidenceVars if v in number],
+            'hidden': [number[v] for v in hidden],
+            'forward': forward,
+            'blanket': blanket,
+            'factors': [(f.values, [number[v] for v in f.get_scope()]) for f in restricted],
+            'query': number[QueryVar]}
+
+def run_gibbs_chains(task):
+    '''Run a group of Gibbs chains (a task built by gibbs_sampling) and
+    return the counts of the values of the query variable'''
+    (model, chains, samples, burn_in, thinning, seed) = task
+    random = np.random.RandomState(seed)
+    state = np.zeros((len(model['sizes']), chains), dtype=np.intp)
+    for (v, index) in model['evidence']:
+        state[v] = index
+    
+    def sample(v, probs, redraw):
+        # Draw a value of v for the chains in redraw; row i of probs is 
+        # (proportional to) the distribution for chain i. Chains where 
+        # every value has probability 0 keep their current value.
+        cumulative = probs.cumsum(axis=1)
+        u = random.random_sample(chains) * cumulative[:, -1]
+        new = np.minimum((cumulative <= u[:, np.newaxis]).sum(axis=1), model['sizes'][v] - 1)
+        state[v] = np.where(redraw & (cumulative[:, -1] > 0), new, state[v])
+    
+    def rows(table, others):
+        # The rows of table selected by each chain's values of others
+        rows = table[tuple([state[o] for o in others])]
+        return rows if others else np.tile(rows, (chains, 1))
+    
+    # Start from a forward sample, redrawn (a bounded number of times) 
+    # for the chains where the evidence has probability 0
+    redraw = np.ones(chains, dtype=bool)
+    for attempt in range(100):
+        for (v, (table, parents)) in zip(model['hidden'], model['forward']):
+            sample(v, rows(table, parents), redraw)
+        weight = np.ones(chains)
+        for (table, scope) in model['factors']:
+            weight *= table[tuple([state[v] for v in scope])]
+        redraw = weight == 0
+        if not redraw.any():
+            break
+    everywhere = np.ones(chains, dtype=bool)
+    
+    query = model['query']
+    counts = np.zeros(model['sizes'][query])
+    sweep = 0
+    counted = 0
+    while counted < samples:
+        for (v, mentions) in zip(model['hidden'], model['blanket']):
+            probs = np.ones((chains, model['sizes'][v]))
+            for (table, others) in mentions:
+                probs *= rows(table, others)
+            sample(v, probs, everywhere)
+        sweep += 1
+        if sweep > burn_in and (sweep - burn_in) % thinning == 0:
+            counts += np.bincount(state[query], minlength=len(counts))
+            counted += 1
+    return counts
+
+
+###############################################################################
+# Query pools
+###############################################################################
+
+class QueryPool:
+    '''A pool of worker processes for answering many VE queries on one 
+    net. The net is given to each worker once, when the pool starts, 
+    and queries are then streamed to the workers by name, e.g.:
+        with QueryPool(bn, min_fill_ordering) as pool:
+            for dist in pool.imap([(SE, {BQ: 'Optimal', AN: True}),
+                                   (TR, {SE: True})]):
+                print dist
+    Each query is a pair (QueryVar, Evidence) as passed to VE_query, 
+    and each answer is the list VE_query returns. 
+    The workers get a copy of the net as it is when the pool is created;
+    later changes to it are not seen by the pool.'''
+    def __init__(self, Net, orderingFn, processes=None):
+        self.pool = multiprocessing.Pool(processes, init_query_worker, (Net, orderingFn))
+
+    def map(self, queries, chunksize=16):
+        '''Answer all the queries and return the list of answers'''
+        return list(self.imap(queries, chunksize))
+
+    def imap(self, queries, chunksize=16):
+        '''Answer the queries, returning an iterator over the answers
+        (in the order of the queries). queries can be any iterable; 
+        they are sent to the workers chunksize at a time as they are 
+        read.'''
+        requests = ((QueryVar.name, [(var.name, value) for (var, value) in Evidence.items()])
+                    for (QueryVar, Evidence) in queries)
+        return self.pool.imap(run_query, requests, chunksize)
+
+    def close(self):
+        '''Stop the workers once they are done'''
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+## The net and ordering function of a QueryPool worker process
+query_worker = {}
+
+def init_query_worker(Net, orderingFn):
+    '''Set up a QueryPool worker process'''
+    query_worker['net'] = Net
+    query_worker['orderingFn'] = orderingFn
+
+def run_query(request):
+    '''Answer a query (sent by QueryPool) in a worker process'''
+    (query_name, evidence) = request
+    Net = query_worker['net']
+    Evidence = dict([(Net.get_variable(name), value) for (name, value) in evidence])
+    return VE_query(Net, Net.get_variable(query_name), Evidence, query_worker['orderingFn'])
+
+###############################################################################
+# Saving and loading nets
+###############################################################################
+
+## Binary net files: the magic string, the format version and the length
+# of the header (little endian unsigned 32 and 64 bit integers), then 
+# the header, a JSON object describing the net, padded with spaces so 
+# that the value block starts at a multiple of BN_FILE_ALIGNMENT bytes.
+# The value block holds the tables of all the factors, one after the
+# other, as little endian float64 numbers in C (row major) order.
+BN_FILE_MAGIC = 'BNETBASE'
+BN_FILE_VERSION = 1
+BN_FILE_ALIGNMENT = 64
+
+def save_bn(Net, filename):
+    '''Save Net to a binary file that load_bn reads back. Variable 
+    domain values must be strings, numbers or booleans.'''
+    Vars = Net.variables()
+    number = dict([(v, i) for (i, v) in enumerate(Vars)])
+    factors = []
+    offset = 0
+    for f in Net.factors():
+        factors.append({'name': f.name, 
+                        'scope': [number[v] for v in f.get_scope()],
+                        'offset': offset,
+                        'log_space': f.log_space})
+        offset += f.values.size
+    header = json.dumps({'name': Net.name,
+                         'log_space': Net.log_space,
+                         'variables': [{'name': v.name, 'domain': v.domain()} for v in Vars],
+                         'factors': factors,
+                         'size': offset})
+    start = len(BN_FILE_MAGIC) + 12
+    header += ' ' * (-(start + len(header)) % BN_FILE_ALIGNMENT)
+    out = open(filename, 'wb')
+    try:
+        out.write(BN_FILE_MAGIC)
+        out.write(struct.pack('<IQ', BN_FILE_VERSION, len(header)))
+        out.write(header)
+        for f in Net.factors():
+            np.ascontiguousarray(f.values, dtype='<f8').tofile(out)
+    finally:
+        out.close()
+
+def load_bn(filename, mmap=True, cache_size=128):
+    '''Load a net saved by save_bn. With mmap set (the default) the
+    value block of the file is memory mapped and the factors' tables 
+    are views into it, so nothing is read or copied until the values 
+    are used, and nets larger than memory can be loaded. The mapping is
+    copy on write: changes to the factors are not written to the file.
+    Otherwise the value block is read into memory.'''
+    source = open(filename, 'rb')
+    try:
+        if source.read(len(BN_FILE_MAGIC)) != BN_FILE_MAGIC:
+            raise ValueError("{} is not a bayes net file".format(filename))
+        (version, header_size) = struct.unpack('<IQ', source.read(12))
+        if version != BN_FILE_VERSION:
+            raise ValueError("{} has unsupported format version {}".format(filename, version))
+        header = json.loads(source.read(header_size))
+        start = len(BN_FILE_MAGIC) + 12 + header_size
+        if not header['size']:
+            block = np.zeros(0)
+        elif mmap:
+            block = np.memmap(filename, dtype='<f8', mode='c', offset=start, shape=(header['size'],))
+        else:
+            block = np.fromfile(source, dtype='<f8', count=header['size'])
+    finally:
+        source.close()
+    
+    Vars = [Variable(plain_string(v['name']), [plain_string(x) for x in v['domain']])
+            for v in header['variables']]
+    Factors = []
+    for f in header['factors']:
+        scope = [Vars[i] for i in f['scope']]
+        shape = [v.domain_size() for v in scope]
+        size = int(np.prod(shape))
+        values = block[f['offset']:f['offset'] + size].reshape(shape)
+        Factors.append(Factor(plain_string(f['name']), scope, values, f['log_space']))
+    return BN(plain_string(header['name']), Vars, Factors, cache_size, header['log_space'])
+
+def plain_string(value):
+    '''JSON strings load as unicode; turn the ASCII ones back into str'''
+    if isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            pass
+    return value
+
+
+###############################################################################
+# BIF and XMLBIF files
+###############################################################################
+
+## The XMLBIF TABLE of a CPT, and the rows of a BIF probability block,
+# list the distributions of the child, one after the other, for each 
+# assignment to the parents, with the last parent varying fastest: the
+# table is ordered (parents..., child). A BIF 'table' entry is ordered
+# the other way around, with the child varying slowest: (child, 
+# parents...), like the factors of a net, whose scope is [child] + 
+# parents.
+
+## How far the distributions of a loaded CPT may sum from 1
+CPT_TOLERANCE = 1e-4
+
+def cpt_factor(child, parents, table):
+    '''Return the CPT of child given parents as a factor, from a flat 
+    table ordered as in BIF/XMLBIF files'''
+    shape = [p.domain_size() for p in parents] + [child.domain_size()]
+    values = np.rollaxis(np.asarray(table, dtype=np.float64).reshape(shape), -1)
+    if (np.abs(values.sum(axis=0) - 1) > CPT_TOLERANCE).any():
+        raise ValueError("The distributions of {} given its parents do not sum to 1".format(child.name))
+    scope = [child] + parents
+    name = 'P({}|{})'.format(child.name, ','.join([p.name for p in parents])) if parents else 'P({})'.format(child.name)
+    return Factor(name, scope, np.ascontiguousarray(values))
+
+def cpt_rows(factor):
+    '''Return the table of factor (a CPT, child first) as a 2-D array 
+    with one row per assignment to the parents, as in BIF/XMLBIF files'''
+    values = factor.to_linear_space().values
+    return np.rollaxis(values, 0, values.ndim).reshape(-1, factor.scope[0].domain_size())
+
+def file_text(value):
+    '''Return value (a name or domain value) as a str to write to a file'''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def load_xmlbif(filename, cache_size=128):
+    '''Load a net from an XMLBIF (version 0.3) file. The file is parsed
+    as a stream: each VARIABLE and DEFINITION element is turned into a
+    variable or a factor as soon as it has been read, and then dropped,
+    so the parser's memory does not grow with the size of the file. 
+    Variables must be declared before the definitions that use them 
+    (as the tools that write the format do). Domain values are strings.
+    Every distribution of a variable given its parents must sum to 1.'''
+    name = ''
+    Vars = []
+    var_names = dict()
+    Factors = []
+    path = []
+    for (event, elem) in ElementTree.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem)
+            continue
+        path.pop()
+        if elem.tag == 'NAME' and len(path) > 0 and path[-1].tag == 'NETWORK':
+            name = (elem.text or '').strip()
+        elif elem.tag == 'VARIABLE':
+            var = Variable(elem.findtext('NAME').strip(),
+                           [o.text.strip() for o in elem.findall('OUTCOME')])
+            Vars.append(var)
+            var_names[var.name] = var
+        elif elem.tag == 'DEFINITION':
+            try:
+                child = var_names[elem.findtext('FOR').strip()]
+                parents = [var_names[g.text.strip()] for g in elem.findall('GIVEN')]
+            except KeyError as error:
+                raise ValueError("{}: undeclared variable {}".format(filename, error))
+            table = np.fromstring(elem.findtext('TABLE'), dtype=np.float64, sep=' ')
+            Factors.append(cpt_factor(child, parents, table))
+        else:
+            continue
+        # Drop the element (and its empty shell in the network)
+        elem.clear()
+        if path and path[-1].tag == 'NETWORK':
+            path[-1].clear()
+    return BN(name, Vars, Factors, cache_size)
+
+def write_xmlbif(Net, filename):
+    '''Write Net to an XMLBIF (version 0.3) file. Every factor of the 
+    net is written as the CPT of the first variable of its scope. Domain
+    values are written as strings.'''
+    out = open(filename, 'w')
+    try:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<BIF VERSION="0.3">\n<NETWORK>\n')
+        out.write('<NAME>{}</NAME>\n'.format(escape(file_text(Net.name))))
+        for var in Net.variables():
+            out.write('<VARIABLE TYPE="nature">\n')
+            out.write('\t<NAME>{}</NAME>\n'.format(escape(file_text(var.name))))
+            for value in var.domain():
+                out.write('\t<OUTCOME>{}</OUTCOME>\n'.format(escape(file_text(value))))
+            out.write('</VARIABLE>\n')
+        for f in Net.factors():
+            scope = f.get_scope()
+            if not scope:
+                continue
+            out.write('<DEFINITION>\n\t<FOR>{}</FOR>\n'.format(escape(file_text(scope[0].name))))
+            for p in scope[1:]:
+                out.write('\t<GIVEN>{}</GIVEN>\n'.format(escape(file_text(p.name))))
+            out.write('\t<TABLE>\n')
+            for row in cpt_rows(f):
+                out.write('\t\t{}\n'.format(' '.join([repr(x) for x in row])))
+            out.write('\t</TABLE>\n</DEFINITION>\n')
+        out.write('</NETWORK>\n</BIF>\n')
+    finally:
+        out.close()
+
+## BIF tokens: quoted strings, punctuation and words (names, values and
+# numbers). Comments are removed first, except inside quoted strings.
+BIF_TOKEN = re.compile(r'"[^"]*"|[{}()\[\]|,;]|[^\s{}()\[\]|,;"]+')
+BIF_WORD = re.compile(r'[^\s{}()\[\]|,;"]+$')
+BIF_SPECIAL = re.compile(r'"|/\*|//')
+
+def bif_tokens(source, filename):
+    '''Generate the tokens of a BIF file, reading it one line at a time.
+    Quoted strings are returned without their quotes.'''
+    in_comment = False
+    for line in source:
+        # The text of the line outside comments (quoted strings are kept
+        # whole, so they may contain /* or //)
+        text = ''
+        while line:
+            if in_comment:
+                end = line.find('*/')
+                if end < 0:
+                    break
+                line = line[end + 2:]
+                in_comment = False
+                continue
+            match = BIF_SPECIAL.search(line)
+            if match is None:
+                text += line
+                break
+            start = match.start()
+            if match.group() == '"':
+                end = line.find('"', start + 1)
+                if end < 0:
+                    raise ValueError("{}: unterminated string in '{}'".format(filename, (text + line).strip()))
+                text += line[:end + 1]
+                line = line[end + 1:]
+            elif match.group() == '//':
+                text += line[:start]
+                break
+            else:
+                text += line[:start] + ' '
+                line = line[start + 2:]
+                in_comment = True
+        for token in BIF_TOKEN.findall(text):
+            if token.startswith('"'):
+                token = token[1:-1]
+            yield token
+
+def load_bif(filename, cache_size=128):
+    '''Load a net from a BIF (interchange format 0.15) file. The file is
+    read as a stream of tokens, and each probability block is filled 
+    into its table in bulk (whole rows at a time) as it is read. Only
+    discrete variables are supported, and variables must be declared 
+    before the probability blocks that use them. Entries of a 
+    probability block can be a 'table' (ordered with the child varying
+    slowest, then the parents, the last one fastest), rows for given 
+    parent values, or a 'default' row for the parent values without a
+    row of their own. Properties are ignored. Domain values are strings.
+    Every distribution of the child must sum to 1.'''
+    name = ''
+    Vars = []
+    var_names = dict()
+    Factors = []
+    source = open(filename)
+    try:
+        tokens = bif_tokens(source, filename)
+        for token in tokens:
+            if token == 'network':
+                name = next(tokens)
+                skip_bif_block(tokens, filename)
+            elif token == 'variable':
+                var = read_bif_variable(tokens, filename)
+                Vars.append(var)
+                var_names[var.name] = var
+            elif token == 'probability':
+                Factors.append(read_bif_probability(tokens, var_names, filename))
+            else:
+                raise ValueError("{}: unexpected '{}'".format(filename, token))
+    except StopIteration:
+        raise ValueError("{}: unexpected end of file".format(filename))
+    finally:
+        source.close()
+    return BN(name, Vars, Factors, cache_size)
+
+def expect_bif_token(tokens, expected, filename):
+    token = next(tokens)
+    if token != expected:
+        raise ValueError("{}: expected '{}', found '{}'".format(filename, expected, token))
+
+def read_bif_list(tokens, end):
+    '''Read the comma separated tokens up to the token end'''
+    items = []
+    for token in tokens:
+        if token == end:
+            return items
+        if token != ',':
+            items.append(token)
+    raise StopIteration
+
+def skip_bif_block(tokens, filename):
+    '''Skip a block in braces (and what is in it)'''
+    expect_bif_token(tokens, '{', filename)
+    depth = 1
+    while depth:
+        token = next(tokens)
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+
+def read_bif_variable(tokens, filename):
+    '''Read a variable block (after the word 'variable')'''
+    var = Variable(next(tokens))
+    expect_bif_token(tokens, '{', filename)
+    for token in tokens:
+        if token == '}':
+            return var
+        if token == 'type':
+            expect_bif_token(tokens, 'discrete', filename)
+            expect_bif_token(tokens, '[', filename)
+            size = int(next(tokens))
+            expect_bif_token(tokens, ']', filename)
+            expect_bif_token(tokens, '{', filename)
+            values = read_bif_list(tokens, '}')
+            if len(values) != size:
+                raise ValueError("{}: variable {} has {} values, not {}".format(filename, var.name, len(values), size))
+            var.add_domain_values(values)
+        read_bif_list(tokens, ';')
+    raise StopIteration
+
+def read_bif_probability(tokens, var_names, filename):
+    '''Read a probability block (after the word 'probability') and 
+    return the CPT it defines'''
+    expect_bif_token(tokens, '(', filename)
+    names = read_bif_list(tokens, ')')
+    try:
+        child = var_names[names[0]]
+        parents = [var_names[n] for n in names[1:] if n != '|']
+    except KeyError as error:
+        raise ValueError("{}: undeclared variable {}".format(filename, error))
+    table = np.empty([p.domain_size() for p in parents] + [child.domain_size()])
+    given = np.zeros([p.domain_size() for p in parents], dtype=bool)
+    default = None
+    expect_bif_token(tokens, '{', filename)
+    for token in tokens:
+        if token == '}':
+            break
+        if token == 'table':
+            # Child first: move its axis last, as in the rows
+            values = np.array(read_bif_list(tokens, ';'), dtype=np.float64)
+            table[...] = np.rollaxis(values.reshape([child.domain_size()] + list(table.shape[:-1])), 0, table.ndim)
+            given[...] = True
+        elif token == 'default':
+            default = np.array(read_bif_list(tokens, ';'), dtype=np.float64)
+        elif token == '(':
+            values = read_bif_list(tokens, ')')
+            index = tuple([p.value_index(v) for (p, v) in zip(parents, values)])
+            table[index] = np.array(read_bif_list(tokens, ';'), dtype=np.float64)
+            given[index] = True
+        else:
+            read_bif_list(tokens, ';')
+    else:
+        raise StopIteration
+    if not given.all():
+        if default is None:
+            raise ValueError("{}: the table of {} is incomplete".format(filename, child.name))
+        table[~given] = default
+    return cpt_factor(child, parents, table)
+
+def write_bif(Net, filename):
+    '''Write Net to a BIF (interchange format 0.15) file. Every factor 
+    of the net is written as the CPT of the first variable of its 
+    scope. Names and values that are not plain BIF words (e.g., that 
+    contain spaces, or /* or // which would start a comment) are 
+    written in double quotes, which load_bif reads.'''
+    def word(value):
+        text = file_text(value)
+        if BIF_WORD.match(text) and not BIF_SPECIAL.search(text):
+            return text
+        if '"' in text:
+            raise ValueError("Cannot write {} to a BIF file".format(text))
+        return '"{}"'.format(text)
+    
+    out = open(filename, 'w')
+    try:
+        out.write('network {} {{\n}}\n'.format(word(Net.name)))
+        for var in Net.variables():
+            out.write('variable {} {{\n'.format(word(var.name)))
+            out.write('  type discrete [ {} ] {{ {} }};\n}}\n'.format(
+                var.domain_size(), ', '.join([word(v) for v in var.domain()])))
+        for f in Net.factors():
+            scope = f.get_scope()
+            if not scope:
+                continue
+            if len(scope) == 1:
+                out.write('probability ( {} ) {{\n'.format(word(scope[0].name)))
+                out.write('  table {};\n}}\n'.format(', '.join([repr(x) for x in cpt_rows(f)[0]])))
+                continue
+            out.write('probability ( {} | {} ) {{\n'.format(
+                word(scope[0].name), ', '.join([word(p.name) for p in scope[1:]])))
+            rows = cpt_rows(f)
+            for (row, values) in zip(rows, itertools.product(*[p.domain() for p in scope[1:]])):
+                out.write('  ({}) {};\n'.format(', '.join([word(v) for v in values]),
+                                                 ', '.join([repr(x) for x in row])))
+            out.write('}\n')
+    finally:
+        out.close()
@@ -0,0 +1,81 @@
+from test_BN_3 import *
+import os
+import tempfile
+
+## Loading the nets of test_BN_3.py from the BIF and XMLBIF files in 
+## fixtures/, then writing them back out and loading them again. Every
+## factor should match the one defined in test_BN_3.py.
+
+directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def check(name, loaded, net, names):
+    same = True
+    for f in net.factors():
+        scope = [loaded.get_variable(names.get(v.name, v.name)) for v in f.get_scope()]
+        g = loaded.cpt(scope[0])
+        same = same and g.get_scope() == scope and np.allclose(g.values, f.values, atol=1e-12) \
+            and [v.domain() for v in g.get_scope()] == [v.domain() for v in f.get_scope()]
+    print '{}: {} variables, {} factors'.format(name, len(loaded.variables()), len(loaded.factors())), \
+        'OK' if same else 'MISMATCH'
+
+asia_names = {'Visit_To_Asia': 'asia', 'Smoking': 'smoke', 'Tuberculosis': 'tub', 
+              'Lung Cancer': 'lung', 'Bronchitis': 'bronc', 'Tuberculosis or Lung Cancer': 'either',
+              'Dyspnea': 'dysp', 'XRay Result': 'xray'}
+temp = tempfile.mkdtemp()
+
+print '-----------------------------------------------------------------------'
+asia = load_bif(os.path.join(directory, 'asia.bif'))
+check('asia.bif', asia, Asia, asia_names)
+q4 = load_xmlbif(os.path.join(directory, 'sampleq4.xml'))
+check('sampleq4.xml', q4, testQ4, {})
+
+## A BIF file in the style of JavaBayes, whose tables list the child's
+## values slowest
+dog = load_bif(os.path.join(directory, 'dog.bif'))
+light_on = dog.cpt(dog.get_variable('light-on'))
+print 'P(light-on | family-out): ', light_on.values.tolist(), \
+    'OK' if light_on.values.tolist() == [[0.6, 0.05], [0.4, 0.95]] else 'MISMATCH'
+dog_out = dog.cpt(dog.get_variable('dog-out'))
+print 'P(dog-out=true | bowel-problem=true, family-out=false): ', \
+    dog_out.get_value(['true', 'true', 'false']), \
+    'OK' if dog_out.get_value(['true', 'true', 'false']) == 0.97 else 'MISMATCH'
+
+## Names and values that look like the start of a comment
+C1 = Variable('a//b', ['x/*y', '/*', 'z*/'])
+C2 = Variable('c/*d', ['//e', 'f'])
+FC1 = Factor('P(C1)', [C1], np.array([0.2, 0.3, 0.5]))
+FC2 = Factor('P(C2|C1)', [C2, C1], np.array([[0.1, 0.6, 0.25], [0.9, 0.4, 0.75]]))
+comments = BN('Comments', [C1, C2], [FC1, FC2])
+
+print '-----------------------------------------------------------------------'
+for net in [Asia, testQ4, asia, q4, dog, comments]:
+    for (write, load, extension) in [(write_bif, load_bif, '.bif'), (write_xmlbif, load_xmlbif, '.xml')]:
+        filename = os.path.join(temp, net.name + extension)
+        write(net, filename)
+        check('{} written and loaded'.format(net.name + extension), load(filename), net, {})
+        os.remove(filename)
+
+## Comments next to quoted strings that contain comment markers
+filename = os.path.join(temp, 'quoted.bif')
+out = open(filename, 'w')
+out.write('network "a /* b" { } // c /* d\n'
+          'variable "x//y" { /* "e */ type discrete [ 2 ] { "/*", "*/" }; }\n'
+          'probability ( "x//y" ) { table 0.25, /* 0.5, */ 0.75; } // "f\n')
+out.close()
+quoted = load_bif(filename)
+var = quoted.variables()[0]
+print 'Quoted comment markers: ', quoted.name, var.name, var.domain(), quoted.cpt(var).values.tolist(), \
+    'OK' if (quoted.name, var.name, var.domain(), quoted.cpt(var).values.tolist()) == \
+        ('a /* b', 'x//y', ['/*', '*/'], [0.25, 0.75]) else 'MISMATCH'
+os.remove(filename)
+os.rmdir(temp)
+
+print '-----------------------------------------------------------------------'
+Dyspnea.set_evidence('present')
+Xray.set_evidence('abnormal')
+print 'Distribution(Lung Cancer | dyspnea, abnormal xray): ', \
+    VE_query(asia, asia.get_variable('lung'), {asia.get_variable('dysp'): 'present',
+                                               asia.get_variable('xray'): 'abnormal'}, min_fill_ordering)
+print 'VE Distribution(Lung Cancer | dyspnea, abnormal xray): ', VE(Asia, Cancer, [Dyspnea, Xray], min_fill_ordering)
+
+print 'done'
@@ -0,0 +1,68 @@
+from test_BN_3 import *
+
+## Compiled queries on the nets of test_BN_3.py. Each plan is run for
+## every combination of evidence values, and each result is compared
+## with VE for the same evidence.
+
+def check_plan(name, net, QueryVar, EvidenceVars):
+    plan = compile_query(net, QueryVar, EvidenceVars, min_fill_ordering)
+    mismatches = 0
+    runs = 0
+    for values in itertools.product(*[v.domain() for v in EvidenceVars]):
+        for (var, value) in zip(EvidenceVars, values):
+            var.set_evidence(value)
+        expected = VE(net, QueryVar, EvidenceVars, min_fill_ordering)
+        for distribution in [plan.run(list(values)), plan.run()]:
+            runs += 1
+            if max([abs(a - b) for (a, b) in zip(distribution, expected)]) > 1e-9:
+                mismatches += 1
+    print '{}: {} runs'.format(name, runs), 'OK' if mismatches == 0 else 'MISMATCH'
+
+print '-----------------------------------------------------------------------'
+check_plan('Plan for Lung Cancer | smoking, xray', Asia, Cancer, [Smoking, Xray])
+check_plan('Plan for Bronchitis | dyspnea, visit, xray', Asia, Bronchitis, [Dyspnea, VisitAsia, Xray])
+check_plan('Plan for Smoking | no evidence', Asia, Smoking, [])
+check_plan('Plan for E | g, w', testQ4, E, [G, W])
+check_plan('Plan for S | e, b, w', testQ4, S, [E, B, W])
+
+print '-----------------------------------------------------------------------'
+plan = compile_query(Asia, Cancer, [Smoking, Xray], min_fill_ordering)
+Smoking.set_evidence('smoker')
+Xray.set_evidence('abnormal')
+print 'Distribution(Lung Cancer | smoker, abnormal xray): ', plan.run(['smoker', 'abnormal'])
+print 'Distribution(Lung Cancer | non-smoker, normal xray): ', plan.run(['non-smoker', 'normal'])
+print 'Distribution(Lung Cancer | smoker, abnormal xray) again: ', plan.run(['smoker', 'abnormal'])
+print 'VE Distribution(Lung Cancer | smoker, abnormal xray): ', VE(Asia, Cancer, [Smoking, Xray], min_fill_ordering)
+
+## Batches: many rows with differing evidence, run in chunks that do not
+## divide the number of rows (so the last chunk is a short one)
+print '-----------------------------------------------------------------------'
+def check_batch(name, net, QueryVar, EvidenceVars, num_rows, chunk_size):
+    random = np.random.RandomState(0)
+    rows = np.array([random.randint(0, v.domain_size(), size=num_rows) for v in EvidenceVars]).T
+    plan = compile_query(net, QueryVar, EvidenceVars, min_fill_ordering)
+    result = plan.run_batch(rows, chunk_size=chunk_size)
+    mismatches = 0
+    for (row, distribution) in zip(rows, result):
+        for (var, index) in zip(EvidenceVars, row):
+            var.set_evidence(var.domain()[index])
+        expected = VE(net, QueryVar, EvidenceVars, min_fill_ordering)
+        if max([abs(a - b) for (a, b) in zip(distribution, expected)]) > 1e-9:
+            mismatches += 1
+    print '{}: {} rows in chunks of {}'.format(name, len(result), chunk_size), \
+        'OK' if mismatches == 0 and len(result) == num_rows else 'MISMATCH'
+
+check_batch('Batch for Lung Cancer | smoking, xray, dyspnea', Asia, Cancer, [Smoking, Xray, Dyspnea], 1000, 64)
+check_batch('Batch for Tuberculosis | visit, xray', Asia, Tuberculosis, [VisitAsia, Xray], 101, 7)
+check_batch('Batch for S | g, w', testQ4, S, [G, W], 50, 8)
+check_batch('Batch for Lung Cancer | smoking (one chunk)', Asia, Cancer, [Smoking], 10, 4096)
+
+Smoking.set_evidence('smoker')
+Xray.set_evidence('abnormal')
+batch = VE_batch(Asia, Cancer, [Smoking, Xray], [[0, 0], [1, 1], [0, 0]], min_fill_ordering)
+print 'VE_batch Distribution(Lung Cancer | smoker, abnormal xray): ', batch[0].tolist(), \
+    'OK' if batch[0].tolist() == batch[2].tolist() and \
+    max([abs(a - b) for (a, b) in zip(batch[0], VE(Asia, Cancer, [Smoking, Xray], min_fill_ordering))]) < 1e-9 \
+    else 'MISMATCH'
+
+print 'done'
@@ -0,0 +1,46 @@
+from bnetbase import *
+
+## Log space queries on a net where C0 is the parent of C1, ..., C400 and
+## the evidence is C1 = ... = C400 = 'a'. P(Ci=a | C0) is 0.01 for C0=a
+## and 0.02 for C0=b, so the probability of the evidence (about 1e-680)
+## underflows to 0 in linear space and linear VE returns nan. In log 
+## space the answer is finite: Pr(C0=a | evidence) = 1/(1 + 2**400).
+
+size = 400
+C0 = Variable('C0', ['a', 'b'])
+Children = [Variable('C{}'.format(i), ['a', 'b']) for i in range(1, size + 1)]
+Factors = [Factor('P(C0)', [C0])]
+Factors[0].add_values([['a', 0.5], ['b', 0.5]])
+for var in Children:
+    f = Factor('P({}|C0)'.format(var.name), [var, C0])
+    f.add_values([['a', 'a', 0.01], ['a', 'b', 0.02], ['b', 'a', 0.99], ['b', 'b', 0.98]])
+    Factors.append(f)
+    var.set_evidence('a')
+expected = [1 / (1 + 2.0**size), 2.0**size / (1 + 2.0**size)]
+
+def check(name, distribution):
+    finite = all([np.isfinite(p) for p in distribution])
+    same = finite and all([abs(a - b) <= 1e-9 * b for (a, b) in zip(distribution, expected)])
+    print '{}: '.format(name), distribution, 'OK' if same else 'MISMATCH'
+
+print '-----------------------------------------------------------------------'
+net = BN('Star', [C0] + Children, Factors)
+with np.errstate(invalid='ignore'):
+    linear = VE(net, C0, Children, min_fill_ordering)
+print 'Linear VE Distribution(C0 | children): ', linear, \
+    '(nan, as expected)' if any([np.isnan(p) for p in linear]) else 'MISMATCH'
+check('VE(log_space=True) Distribution(C0 | children)',
+      VE(net, C0, Children, min_fill_ordering, log_space=True))
+
+print '-----------------------------------------------------------------------'
+log_net = BN('Star', [C0] + Children, Factors, log_space=True)
+check('Log space net VE Distribution(C0 | children)', VE(log_net, C0, Children, min_fill_ordering))
+check('Log space net compiled Distribution(C0 | children)',
+      compile_query(log_net, C0, Children, min_fill_ordering).run())
+check('compile_query(log_space=True) Distribution(C0 | children)',
+      compile_query(net, C0, Children, min_fill_ordering, log_space=True).run())
+tree = JunctionTree(log_net, min_fill_ordering)
+tree.calibrate(Children)
+check('Log space junction tree Distribution(C0 | children)', tree.marginal(C0))
+
+print 'done'
@@ -0,0 +1,143 @@
+from test_BN_3 import *
+
+## Elimination orderings on a net with variables of 2, 3 and 4 values
+## (the 3 valued EMG of seizure.py, and a 4 valued EEG). Every ordering
+## function must give the same VE answers, and at each step it must
+## eliminate a variable with the lowest score (fill, degree, weight or
+## weighted fill) in the interaction graph left by the earlier steps.
+
+TR = Variable('Trauma', [True, False])
+BQ = Variable('Blood', ['Optimal', 'Imbalanced', 'Severe'])
+SE = Variable('Seizure', [True, False])
+ER = Variable('Error_EMG', ['10%', '25%+'])
+EMG = Variable('EMG', ['Periodic_convulsion', 'Normal', 'Sustained_contraction'])
+EEG = Variable('EEG', ['~50', '~150', '~500', '1000+'])
+FTR = Factor('P(TR)', [TR], np.array([0.3, 0.7]))
+FBQ = Factor('P(BQ)', [BQ], np.array([0.6, 0.3, 0.1]))
+FSE = Factor('P(SE|TR,BQ)', [SE, TR, BQ], np.array([[[0.6, 0.8, 0.9], [0.1, 0.4, 0.7]],
+                                                    [[0.4, 0.2, 0.1], [0.9, 0.6, 0.3]]]))
+FER = Factor('P(ER)', [ER], np.array([0.8, 0.2]))
+FEMG = Factor('P(EMG|SE,ER)', [EMG, SE, ER], np.array([[[0.7, 0.5], [0.05, 0.2]],
+                                                      [[0.1, 0.3], [0.9, 0.6]],
+                                                      [[0.2, 0.2], [0.05, 0.2]]]))
+FEEG = Factor('P(EEG|SE,BQ)', [EEG, SE, BQ], np.array([[[0.05, 0.05, 0.1], [0.3, 0.2, 0.1]],
+                                                      [[0.15, 0.15, 0.2], [0.5, 0.5, 0.4]],
+                                                      [[0.3, 0.3, 0.3], [0.15, 0.2, 0.3]],
+                                                      [[0.5, 0.5, 0.4], [0.05, 0.1, 0.2]]]))
+Mixed = BN('Mixed', [TR, BQ, SE, ER, EMG, EEG], [FTR, FBQ, FSE, FER, FEMG, FEEG])
+
+orderings = [('min fill', min_fill_ordering, fill_score),
+             ('min degree', min_degree_ordering, degree_score),
+             ('min weight', min_weight_ordering, weight_score),
+             ('weighted min fill', weighted_min_fill_ordering, weighted_fill_score)]
+
+def check_greedy(name, orderingFn, scoreFn, factors, QueryVar):
+    order = orderingFn(factors, QueryVar)
+    (graph, Vars) = interaction_graph(factors)
+    greedy = sorted(order, key=lambda v: v.name) == sorted([v for v in Vars if v is not QueryVar], key=lambda v: v.name)
+    for var in order:
+        best = min([scoreFn(graph, v) for v in graph if v is not QueryVar])
+        greedy = greedy and scoreFn(graph, var) == best
+        neighbors = graph.pop(var)
+        for n in neighbors:
+            graph[n].discard(var)
+            graph[n].update(neighbors)
+            graph[n].discard(n)
+    print '{} ordering for {}: '.format(name, QueryVar.name), [v.name for v in order], \
+        'OK' if greedy else 'NOT GREEDY'
+
+print '-----------------------------------------------------------------------'
+for var in [SE, TR, EMG, EEG]:
+    for (name, orderingFn, scoreFn) in orderings:
+        check_greedy(name, orderingFn, scoreFn, Mixed.factors(), var)
+
+print '-----------------------------------------------------------------------'
+EMG.set_evidence('Periodic_convulsion')
+EEG.set_evidence('1000+')
+for var in [SE, TR, BQ]:
+    expected = VE(Mixed, var, [EMG, EEG], min_fill_ordering)
+    same = all([max([abs(a - b) for (a, b) in zip(VE(Mixed, var, [EMG, EEG], orderingFn), expected)]) < 1e-12
+                for (name, orderingFn, scoreFn) in orderings])
+    print 'Distribution({} | EMG, EEG): '.format(var.name), expected, 'OK' if same else 'MISMATCH'
+
+## Min fill and min degree differ: A, X, B and C form a cycle, so each
+## has only two neighbors, but eliminating any of them adds an edge; the
+## neighbors of Y (and of P, Q, R) are all connected already
+print '-----------------------------------------------------------------------'
+(A, X, B, C, Y, P, Q, R) = [Variable(name, [0, 1]) for name in 'AXBCYPQR']
+factors = [Factor('f1', [A, X]), Factor('f2', [X, B]), Factor('f3', [B, C]), Factor('f4', [C, A]),
+           Factor('f5', [Y, P, Q, R])]
+def check_first(name, order, expected):
+    print 'First eliminated by {}: '.format(name), order[0].name, 'OK' if order[0] is expected else 'MISMATCH'
+
+check_first('min fill', min_fill_ordering(factors, None), Y)
+check_first('min degree', min_degree_ordering(factors, None), A)
+# Weight: eliminating a 4 valued variable next to a 2 valued one makes a
+# bigger table than two 2 valued ones
+(U, V, W) = [Variable('U', range(4)), Variable('V', range(2)), Variable('W', range(2))]
+check_first('min weight', min_weight_ordering([Factor('g1', [U, V]), Factor('g2', [V, W])], None), W)
+
+## Pruning: the factors that cannot change an answer are left out of
+## VE, and the answers match the product of all the net's factors
+print '-----------------------------------------------------------------------'
+def unpruned(net, QueryVar, EvidenceVars):
+    evidence = dict([(v, v.evidence_index) for v in EvidenceVars])
+    joint = create_product_factor(restrict_factors(net.factors(), evidence), None)
+    marginal = eliminate_vars(joint, [v for v in joint.get_scope() if v is not QueryVar])
+    return (marginal.values / marginal.values.sum()).tolist()
+
+def check_pruning(name, QueryVar, EvidenceVars, dropped):
+    kept = relevant_factors(Mixed, QueryVar, EvidenceVars)
+    expected = unpruned(Mixed, QueryVar, EvidenceVars)
+    distribution = VE(Mixed, QueryVar, EvidenceVars, min_fill_ordering)
+    same = max([abs(a - b) for (a, b) in zip(distribution, expected)]) < 1e-12
+    print '{}: kept'.format(name), [f.name for f in kept], \
+        'OK' if same and set(Mixed.factors()) - set(kept) == set(dropped) else 'MISMATCH'
+
+TR.set_evidence(True)
+# The EMG and EEG CPTs (and the prior of the EMG error) are barren, and
+# the trauma evidence d-separates its prior
+check_pruning('Seizure | trauma', SE, [TR], [FEMG, FEEG, FER, FTR])
+SE.set_evidence(True)
+# The seizure evidence d-separates EMG from its causes
+check_pruning('EMG | seizure', EMG, [SE], [FTR, FBQ, FSE, FEEG])
+EMG.set_evidence('Normal')
+check_pruning('Trauma | EMG, EEG', TR, [EMG, EEG], [])
+
+## Ordering cache: orderings are reused for the same query variable and
+## evidence variables, the least recently used one is evicted, and
+## changing the net drops them all
+print '-----------------------------------------------------------------------'
+calls = []
+def counting_ordering(Factors, QueryVar):
+    calls.append(QueryVar)
+    return min_fill_ordering(Factors, QueryVar)
+
+def check_calls(name, expected):
+    print '{}: {} orderings computed, {} cached'.format(name, len(calls), len(net.ordering_cache)), \
+        'OK' if len(calls) == expected[0] and len(net.ordering_cache) == expected[1] else 'MISMATCH'
+
+net = BN('Mixed', Mixed.variables(), Mixed.factors(), cache_size=2)
+EMG.set_evidence('Normal')
+EEG.set_evidence('~150')
+VE(net, SE, [EMG, EEG], counting_ordering)
+EMG.set_evidence('Periodic_convulsion')
+VE(net, SE, [EEG, EMG], counting_ordering)
+check_calls('Same query, other evidence values', (1, 1))
+VE(net, TR, [EMG, EEG], counting_ordering)
+VE(net, SE, [EMG, EEG], counting_ordering)
+check_calls('Second query variable', (2, 2))
+VE(net, BQ, [EMG, EEG], counting_ordering)
+check_calls('Third query variable', (3, 2))
+VE(net, SE, [EMG, EEG], counting_ordering)
+check_calls('First query again (still cached)', (3, 2))
+VE(net, TR, [EMG, EEG], counting_ordering)
+check_calls('Second query again (evicted)', (4, 2))
+net.clear_caches()
+check_calls('After clear_caches', (4, 0))
+VE(net, SE, [EMG, EEG], counting_ordering)
+check_calls('First query after clear_caches', (5, 1))
+net.add_factors([])
+check_calls('After add_factors', (5, 0))
+
+print 'done'
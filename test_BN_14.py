@@ -0,0 +1,60 @@
+from test_BN_3 import *
+import sys
+import StringIO
+
+## The DAG indexes of a net: parents, children, roots and a topological
+## order, kept up to date by add_variables/add_factors and rebuilt by
+## clear_caches after the net's lists are changed in place.
+
+def check(label, got, expected):
+    print label, got, 'OK' if got == expected else 'MISMATCH'
+
+def names(Vars):
+    return [v.name for v in Vars]
+
+print '-----------------------------------------------------------------------'
+for (var, parents, children) in [(VisitAsia, [], ['Tuberculosis']),
+                                 (Smoking, [], ['Lung Cancer', 'Bronchitis']),
+                                 (TBorCA, ['Tuberculosis', 'Lung Cancer'], ['Dyspnea', 'XRay Result']),
+                                 (Dyspnea, ['Tuberculosis or Lung Cancer', 'Bronchitis'], [])]:
+    check('Parents of {}: '.format(var.name), names(Asia.parents(var)), parents)
+    check('Children of {}: '.format(var.name), names(Asia.children(var)), children)
+check('Roots: ', names(Asia.roots()), ['Visit_To_Asia', 'Smoking'])
+order = Asia.topological_order()
+position = dict([(v, i) for (i, v) in enumerate(order)])
+check('Topological order covers the net: ', sorted(names(order)), sorted(names(Asia.variables())))
+check('Parents come first: ', all([position[p] < position[v] for v in order for p in Asia.parents(v)]), True)
+
+## Changing the lists in place, then clear_caches
+print '-----------------------------------------------------------------------'
+X = Variable('X', ['x', '-x'])
+Y = Variable('Y', ['y', '-y'])
+FX = Factor('P(X)', [X], np.array([0.3, 0.7]))
+FY = Factor('P(Y|X)', [Y, X], np.array([[0.9, 0.1], [0.1, 0.9]]))
+net = BN('n', [X], [FX])
+X.set_evidence('x')
+print 'Distribution(X): ', VE(net, X, [], min_fill_ordering)
+net.Variables.append(Y)
+net.Factors.append(FY)
+net.clear_caches()
+Y.set_evidence('y')
+distribution = VE(net, X, [Y], min_fill_ordering)
+expected = [0.3*0.9/(0.3*0.9 + 0.7*0.1), 0.7*0.1/(0.3*0.9 + 0.7*0.1)]
+same = max([abs(a - b) for (a, b) in zip(distribution, expected)]) < 1e-12
+print 'Distribution(X | y) after adding Y in place: ', distribution, 'OK' if same else 'MISMATCH'
+check('Children of X: ', names(net.children(X)), ['Y'])
+check('Topological order: ', names(net.topological_order()), ['X', 'Y'])
+
+## A cycle in the parents is reported
+print '-----------------------------------------------------------------------'
+Z = Variable('Z', ['z', '-z'])
+FXZ = Factor('P(X|Z)', [X, Z], np.array([[0.5, 0.5], [0.5, 0.5]]))
+FZY = Factor('P(Z|Y)', [Z, Y], np.array([[0.5, 0.5], [0.5, 0.5]]))
+out = StringIO.StringIO()
+sys.stdout = out
+cyclic = BN('cycle', [X, Y, Z], [FXZ, FY, FZY])
+sys.stdout = sys.__stdout__
+check('Cycle reported: ', 'form a cycle' in out.getvalue(), True)
+check('Topological order stops at the cycle: ', names(cyclic.topological_order()), [])
+
+print 'done'
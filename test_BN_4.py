@@ -0,0 +1,88 @@
+from test_BN_3 import *
+
+## Junction tree tests on the nets of test_BN_3.py
+## Every marginal from the calibrated tree should match VE.
+
+def check_marginals(net, EvidenceVars, reference=None):
+    # Compares with VE on reference (net itself by default)
+    jt = JunctionTree(net, min_fill_ordering)
+    jt.calibrate(EvidenceVars)
+    marginals = jt.marginals()
+    for var in net.variables():
+        if var in EvidenceVars:
+            continue
+        distribution = VE(reference or net, var, EvidenceVars, min_fill_ordering)
+        same = max([abs(a - b) for (a, b) in zip(distribution, marginals[var])]) < 1e-9
+        print 'Distribution({}): '.format(var.name), marginals[var], 'OK' if same else 'MISMATCH', distribution
+
+print '-----------------------------------------------------------------------'
+check_marginals(Asia, [])
+print '-----------------------------------------------------------------------'
+Smoking.set_evidence('smoker')
+Xray.set_evidence('abnormal')
+check_marginals(Asia, [Smoking, Xray])
+print '-----------------------------------------------------------------------'
+Dyspnea.set_evidence('present')
+VisitAsia.set_evidence('visit')
+check_marginals(Asia, [Dyspnea, VisitAsia])
+print '-----------------------------------------------------------------------'
+G.set_evidence('g')
+check_marginals(testQ4, [G])
+print '-----------------------------------------------------------------------'
+W.set_evidence('-w')
+E.set_evidence('e')
+check_marginals(testQ4, [W, E])
+
+## Factors stored in log space, and trees working in log space
+print '-----------------------------------------------------------------------'
+AsiaLog = BN("Asia", Asia.variables(), [f.to_log_space() for f in Asia.factors()])
+check_marginals(AsiaLog, [Dyspnea, VisitAsia], Asia)
+print '-----------------------------------------------------------------------'
+check_marginals(BN("Asia", Asia.variables(), Asia.factors(), log_space=True), [Dyspnea, VisitAsia], Asia)
+print '-----------------------------------------------------------------------'
+check_marginals(BN("Asia", Asia.variables(), AsiaLog.factors(), log_space=True), [Dyspnea, VisitAsia], Asia)
+
+## Inference session: findings arrive one at a time
+print '-----------------------------------------------------------------------'
+session = InferenceSession(Asia, min_fill_ordering)
+print 'Distribution(Lung Cancer): ', session.marginal(Cancer)
+session.add_evidence(Smoking, 'smoker')
+print 'Distribution(Lung Cancer | smoker): ', session.marginal(Cancer)
+session.add_evidence(Xray, 'abnormal')
+print 'Distribution(Lung Cancer | smoker, abnormal xray): ', session.marginal(Cancer)
+session.retract_evidence(Smoking)
+print 'Distribution(Lung Cancer | abnormal xray): ', session.marginal(Cancer)
+Xray.set_evidence('abnormal')
+print 'VE Distribution(Lung Cancer | abnormal xray): ', VE(Asia, Cancer, [Xray], min_fill_ordering)
+
+## Precomputed marginals: queries with no evidence or evidence only on
+## roots are looked up, and the lookups follow changes to the CPTs
+print '-----------------------------------------------------------------------'
+def check_lookups(net):
+    for (var, evidence) in [(Cancer, {}), (Dyspnea, {Smoking: 'smoker'}),
+                            (Xray, {Smoking: 'non-smoker', VisitAsia: 'visit'})]:
+        looked_up = VE_query(net, var, evidence, min_fill_ordering)
+        computed = VE_query(Asia, var, evidence, min_fill_ordering)
+        same = max([abs(a - b) for (a, b) in zip(looked_up, computed)]) < 1e-9
+        print 'Distribution({} | {}): '.format(var.name, evidence.values()), looked_up, 'OK' if same else 'MISMATCH'
+
+AsiaPre = BN("Asia", Asia.variables(), Asia.factors(), precompute=True)
+print 'Roots: ', [v.name for v in AsiaPre.roots()], 'kept:', len(AsiaPre.marginal_table)
+check_lookups(AsiaPre)
+print 'Factors stored in log space:'
+check_lookups(BN("Asia", Asia.variables(), [f.to_log_space() for f in Asia.factors()], precompute=True))
+print 'Net in log space:'
+check_lookups(BN("Asia", Asia.variables(), [f.to_log_space() for f in Asia.factors()],
+                 log_space=True, precompute=True))
+print 'Only the empty evidence and the values of the first root kept:'
+AsiaFew = BN("Asia", Asia.variables(), Asia.factors(), precompute=True, max_combinations=3)
+check_lookups(AsiaFew)
+print 'Kept after queries outside the table: ', len(AsiaFew.marginal_table), \
+    'OK' if len(AsiaFew.marginal_table) == 3 else 'MISMATCH'
+F2.add_values([['smoker', 0.2], ['non-smoker', 0.8]])
+looked_up = VE_query(AsiaPre, Cancer, {}, min_fill_ordering)
+print 'Distribution(Lung Cancer) after changing P(Smoking): ', looked_up, \
+    'OK' if abs(looked_up[0] - VE_query(Asia, Cancer, {}, min_fill_ordering)[0]) < 1e-9 else 'MISMATCH'
+F2.add_values([['smoker', 0.5], ['non-smoker', 0.5]])
+
+print 'done'
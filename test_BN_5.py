@@ -0,0 +1,59 @@
+from test_BN_3 import *
+
+## Approximate inference tests on the nets of test_BN_3.py
+## The sampled distributions should be within bound of the VE ones. 
+## With 200000 samples the standard error of each probability is about
+## 0.001 (more for weighted or correlated samples), so 0.01 is a loose
+## bound that a broken sampler still misses.
+
+def compare(name, distribution, estimate, bound=0.01):
+    error = max([abs(a - b) for (a, b) in zip(distribution, estimate)])
+    print '{}: VE = {}, estimate = {}, error = {:.4f}'.format(name, distribution, estimate, error), \
+        'OK' if error < bound else 'MISMATCH'
+
+print '-----------------------------------------------------------------------'
+Smoking.set_evidence('smoker')
+Xray.set_evidence('abnormal')
+compare('LW Distribution(Lung Cancer | smoker, abnormal xray)',
+        VE(Asia, Cancer, [Smoking, Xray], min_fill_ordering),
+        likelihood_weighting(Asia, Cancer, [Smoking, Xray], num_samples=200000, seed=0))
+print '-----------------------------------------------------------------------'
+Dyspnea.set_evidence('present')
+stats = dict()
+compare('LW Distribution(Bronchitis | dyspnea)',
+        VE(Asia, Bronchitis, [Dyspnea], min_fill_ordering),
+        likelihood_weighting(Asia, Bronchitis, [Dyspnea], num_samples=1000000,
+                             tolerance=0.002, seed=0, stats=stats), bound=5*0.002)
+print 'Samples drawn for a standard error of 0.002: ', stats['samples'], \
+    'OK' if stats['samples'] < 1000000 else 'MISMATCH'
+print '-----------------------------------------------------------------------'
+G.set_evidence('g')
+W.set_evidence('-w')
+compare('LW Distribution(E | g, -w)',
+        VE(testQ4, E, [G, W], min_fill_ordering),
+        likelihood_weighting(testQ4, E, [G, W], num_samples=200000, seed=0))
+
+## Gibbs sampling, with the chains run in this process and spread over
+## two worker processes. (The Asia net is left out: its deterministic 
+## 'Tuberculosis or Lung Cancer' node keeps single variable Gibbs chains
+## from mixing.)
+print '-----------------------------------------------------------------------'
+estimates = dict()
+for processes in [1, 2]:
+    estimates[processes] = gibbs_sampling(testQ4, E, [G, W], num_samples=200000, burn_in=200,
+                                          thinning=2, chains=40, processes=processes, seed=0)
+    compare('Gibbs (processes={}) Distribution(E | g, -w)'.format(processes),
+            VE(testQ4, E, [G, W], min_fill_ordering), estimates[processes])
+    again = gibbs_sampling(testQ4, E, [G, W], num_samples=200000, burn_in=200,
+                           thinning=2, chains=40, processes=processes, seed=0)
+    print 'Same estimate again for the same seed: ', 'OK' if again == estimates[processes] else 'MISMATCH'
+error = max([abs(a - b) for (a, b) in zip(estimates[1], estimates[2])])
+print 'Estimates with 1 and 2 processes agree: ', 'OK' if error < 0.01 else 'MISMATCH'
+print '-----------------------------------------------------------------------'
+B.set_evidence('b')
+compare('Gibbs Distribution(S | b, -w)',
+        VE(testQ4, S, [B, W], min_fill_ordering),
+        gibbs_sampling(testQ4, S, [B, W], num_samples=200000, burn_in=200,
+                       chains=40, processes=2, seed=1))
+
+print 'done'
@@ -0,0 +1,59 @@
+from test_BN_3 import *
+import threading
+
+## Queries with the evidence passed in (VE_query), from several threads
+## and from a pool of worker processes, on the nets of test_BN_3.py.
+## Every answer should match VE.
+
+queries = [(Cancer, {Smoking: 'smoker', Xray: 'abnormal'}),
+           (Bronchitis, {Dyspnea: 'present'}),
+           (Tuberculosis, {Dyspnea: 'present', VisitAsia: 'visit'}),
+           (TBorCA, {}),
+           (Smoking, {Xray: 'normal', Bronchitis: 'absent'})]
+
+def expected(query):
+    (QueryVar, Evidence) = query
+    for (var, value) in Evidence.items():
+        var.set_evidence(value)
+    return VE(Asia, QueryVar, Evidence.keys(), min_fill_ordering)
+
+def check(name, answers):
+    same = all([max([abs(a - b) for (a, b) in zip(answer, expected(query))]) < 1e-9
+                for (query, answer) in zip(queries, answers)])
+    print '{}: {} answers'.format(name, len(answers)), 'OK' if same else 'MISMATCH'
+
+print '-----------------------------------------------------------------------'
+Cancer.set_evidence('absent')
+print 'Distribution(Lung Cancer | smoker, abnormal xray): ', \
+    VE_query(Asia, Cancer, {Smoking: 'smoker', Xray: 'abnormal'}, min_fill_ordering)
+
+print '-----------------------------------------------------------------------'
+answers = [None] * len(queries) * 20
+def worker(t):
+    for i in range(t, len(answers), 4):
+        (QueryVar, Evidence) = queries[i % len(queries)]
+        answers[i] = VE_query(Asia, QueryVar, Evidence, min_fill_ordering)
+threads = [threading.Thread(target=worker, args=(t,)) for t in range(4)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+check('Threads', answers[:len(queries)])
+print 'All thread answers agree: ', all([answers[i] == answers[i % len(queries)] for i in range(len(answers))])
+
+print '-----------------------------------------------------------------------'
+with QueryPool(Asia, min_fill_ordering, processes=2) as pool:
+    check('Query pool', pool.map(queries, chunksize=2))
+
+## Query engine: the queries share intermediate factors
+print '-----------------------------------------------------------------------'
+engine = QueryEngine(Asia, min_fill_ordering)
+check('Query engine', [engine.query(QueryVar, Evidence) for (QueryVar, Evidence) in queries])
+evidence = {Dyspnea: 'present', Xray: 'abnormal'}
+marginals = engine.marginals([v for v in Asia.variables() if v not in evidence], evidence)
+for (var, distribution) in marginals.items():
+    same = max([abs(a - b) for (a, b) in zip(distribution, VE_query(Asia, var, evidence, min_fill_ordering))]) < 1e-9
+    print 'Distribution({} | dyspnea, abnormal xray): '.format(var.name), distribution, 'OK' if same else 'MISMATCH'
+print 'Cached eliminations used: {}, computed: {}'.format(engine.hits, engine.misses)
+
+print 'done'
@@ -0,0 +1,50 @@
+from test_BN_3 import *
+
+## MAP/MPE tests on the nets of test_BN_3.py. The max-product answers 
+## are compared with the best assignment found by enumerating every
+## assignment of the MAP variables and computing its probability with
+## the chain rule and VE.
+
+def brute_force(net, MapVars, EvidenceVars):
+    evidence = [(v, v.get_evidence()) for v in EvidenceVars]
+    best = (None, -1)
+    for values in itertools.product(*[v.domain() for v in MapVars]):
+        probability = 1.0
+        known = list(EvidenceVars)
+        for (var, value) in zip(MapVars, values):
+            probability *= VE(net, var, known, min_fill_ordering)[var.value_index(value)]
+            var.set_evidence(value)
+            known.append(var)
+        if probability > best[1]:
+            best = (dict(zip(MapVars, values)), probability)
+        for (var, value) in evidence:
+            var.set_evidence(value)
+    return best
+
+def check(name, net, MapVars, EvidenceVars, log_space=False):
+    (assignment, probability) = MAP(net, MapVars, EvidenceVars, min_fill_ordering, log_space)
+    (expected, expected_probability) = brute_force(net, MapVars, EvidenceVars)
+    same = assignment == expected and abs(probability - expected_probability) < 1e-9
+    print '{}: {} {:.6f}'.format(name, dict([(v.name, x) for (v, x) in assignment.items()]), probability), \
+        'OK' if same else 'MISMATCH'
+
+print '-----------------------------------------------------------------------'
+Dyspnea.set_evidence('present')
+Xray.set_evidence('abnormal')
+check('MAP(Tuberculosis, Lung Cancer, Bronchitis | dyspnea, abnormal xray)',
+      Asia, [Tuberculosis, Cancer, Bronchitis], [Dyspnea, Xray])
+check('MAP(Smoking | dyspnea, abnormal xray), in log space',
+      Asia, [Smoking], [Dyspnea, Xray], log_space=True)
+print '-----------------------------------------------------------------------'
+VisitAsia.set_evidence('visit')
+check('MPE(dyspnea, abnormal xray, visit)',
+      Asia, [v for v in Asia.variables() if v not in [Dyspnea, Xray, VisitAsia]],
+      [Dyspnea, Xray, VisitAsia])
+print '-----------------------------------------------------------------------'
+G.set_evidence('g')
+W.set_evidence('-w')
+check('MAP(E, B | g, -w)', testQ4, [E, B], [G, W])
+(assignment, probability) = MPE(testQ4, [G, W], min_fill_ordering)
+print 'MPE(g, -w): ', dict([(v.name, x) for (v, x) in assignment.items()]), probability
+
+print 'done'
@@ -0,0 +1,41 @@
+from test_BN_3 import *
+
+## Joint posterior queries on the nets of test_BN_3.py. Each joint is
+## checked against the chain rule computed with single variable VE.
+
+def chain_rule(net, QueryVars, EvidenceVars, values):
+    evidence = [(v, v.get_evidence()) for v in EvidenceVars]
+    probability = 1.0
+    known = list(EvidenceVars)
+    for (var, value) in zip(QueryVars, values):
+        probability *= VE(net, var, known, min_fill_ordering)[var.value_index(value)]
+        var.set_evidence(value)
+        known.append(var)
+    for (var, value) in evidence:
+        var.set_evidence(value)
+    return probability
+
+def check(name, net, QueryVars, EvidenceVars):
+    joint = VE_joint(net, QueryVars, EvidenceVars, min_fill_ordering)
+    same = all([abs(joint.get_value(list(values)) - chain_rule(net, QueryVars, EvidenceVars, values)) < 1e-9
+                for values in itertools.product(*[v.domain() for v in QueryVars])])
+    print name, 'OK' if same else 'MISMATCH'
+    joint.print_table()
+
+print '-----------------------------------------------------------------------'
+Xray.set_evidence('abnormal')
+check('Distribution(Tuberculosis, Lung Cancer | abnormal xray)', Asia, [Tuberculosis, Cancer], [Xray])
+print '-----------------------------------------------------------------------'
+Dyspnea.set_evidence('present')
+check('Distribution(Bronchitis, Smoking, Visit_To_Asia | dyspnea, abnormal xray)',
+      Asia, [Bronchitis, Smoking, VisitAsia], [Dyspnea, Xray])
+print '-----------------------------------------------------------------------'
+G.set_evidence('g')
+check('Distribution(E, B | g)', testQ4, [E, B], [G])
+print '-----------------------------------------------------------------------'
+try:
+    VE(testQ4, G, [G], min_fill_ordering)
+except ValueError as error:
+    print 'Query on an evidence variable: ', error
+
+print 'done'
@@ -0,0 +1,51 @@
+from test_BN_3 import *
+import os
+import tempfile
+
+## Saving the nets of test_BN_3.py to binary files and loading them back
+## (memory mapped and read into memory). Queries on the loaded nets
+## should match VE on the original ones.
+
+def check(name, net, QueryVar, EvidenceVars):
+    filename = os.path.join(tempfile.mkdtemp(), net.name + '.bn')
+    save_bn(net, filename)
+    Evidence = dict([(v, v.get_evidence()) for v in EvidenceVars])
+    expected = VE(net, QueryVar, EvidenceVars, min_fill_ordering)
+    for mmap in [True, False]:
+        loaded = load_bn(filename, mmap)
+        renamed = dict([(loaded.get_variable(v.name), value) for (v, value) in Evidence.items()])
+        distribution = VE_query(loaded, loaded.get_variable(QueryVar.name), renamed, min_fill_ordering)
+        same = max([abs(a - b) for (a, b) in zip(distribution, expected)]) < 1e-12
+        print '{} ({}): '.format(name, 'memory mapped' if mmap else 'read'), distribution, 'OK' if same else 'MISMATCH'
+    
+    # Loaded factors can be changed without changing the file
+    loaded = load_bn(filename)
+    loaded.factors()[0].values[...] = 0
+    print 'File unchanged: ', np.array_equal(load_bn(filename).factors()[0].values, net.factors()[0].values)
+    os.remove(filename)
+    os.rmdir(os.path.dirname(filename))
+
+print '-----------------------------------------------------------------------'
+Smoking.set_evidence('smoker')
+Xray.set_evidence('abnormal')
+check('Distribution(Lung Cancer | smoker, abnormal xray)', Asia, Cancer, [Smoking, Xray])
+print '-----------------------------------------------------------------------'
+G.set_evidence('g')
+W.set_evidence('-w')
+check('Distribution(E | g, -w)', testQ4, E, [G, W])
+
+## Pickled nets (at the default protocol and the highest one)
+print '-----------------------------------------------------------------------'
+import pickle
+Cancer.set_evidence('present')
+for protocol in [0, pickle.HIGHEST_PROTOCOL]:
+    loaded = pickle.loads(pickle.dumps(Asia, protocol))
+    renamed = dict([(loaded.get_variable(v.name), v.get_evidence()) for v in [Smoking, Xray]])
+    distribution = VE_query(loaded, loaded.get_variable(Cancer.name), renamed, min_fill_ordering)
+    expected = VE(Asia, Cancer, [Smoking, Xray], min_fill_ordering)
+    same = max([abs(a - b) for (a, b) in zip(distribution, expected)]) < 1e-12
+    print 'Pickled (protocol {}) Distribution(Lung Cancer | smoker, abnormal xray): '.format(protocol), \
+        distribution, 'OK' if same else 'MISMATCH'
+print 'Pickled variable: ', pickle.loads(pickle.dumps(Cancer)).get_evidence()
+
+print 'done'